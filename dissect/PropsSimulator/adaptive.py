@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import scanpy as sc
+from scipy.optimize import nnls
+from scipy.sparse import csr_matrix, diags, issparse
+from dissect.PropsSimulator.sampling import celltype_profiles
+from dissect.utils.ingest import read_table_cached
+
+
+def read_real_samples(config):
+    """
+    The real samples of deconv_params test_dataset, on the linear scale:
+    their expression (samples x genes, CSR if the h5ad test dataset is
+    sparse), sample names and genes. Of duplicated genes the first is kept.
+    """
+    if config["deconv_params"]["test_dataset_format"] == "txt":
+        df = read_table_cached(config["deconv_params"]["test_dataset"])
+        X, samples, genes = df.to_numpy().T, df.columns, df.index
+    else:
+        adata = sc.read(config["deconv_params"]["test_dataset"])
+        X = csr_matrix(adata.X) if issparse(adata.X) else np.asarray(adata.X)
+        samples, genes = adata.obs_names, adata.var_names
+    if config["deconv_params"]["test_dataset_type"] == "microarray":
+        # 2**0 - 1 = 0, sparse entries stay zero
+        if issparse(X):
+            X = X.astype(np.float64)
+            X.data = np.maximum(2**X.data - 1, 0)
+        else:
+            X = np.maximum(2**X - 1, 0)
+    first = np.flatnonzero(~pd.Index(genes).duplicated(keep="first"))
+    return X[:, first], pd.Index(samples), pd.Index(genes)[first]
+
+
+def nnls_fractions(real, profiles):
+    """
+    Fractions of cells of each cell-type in the real samples (samples x
+    genes, dense or sparse), from non-negative least squares against the mean
+    expression of a cell of each cell-type (cell-types x genes) and
+    normalized to sum to 1. Sparse samples are densified one at a time.
+    Samples explained by no cell-type get equal fractions.
+    """
+    samples = (
+        (real[i].toarray().ravel() for i in range(real.shape[0])) if issparse(real) else real
+    )
+    fractions = np.array([nnls(profiles.T, sample)[0] for sample in samples])
+    totals = fractions.sum(axis=1, keepdims=True)
+    fractions = np.where(totals > 0, fractions / np.where(totals > 0, totals, 1), 1 / profiles.shape[0])
+    return fractions.astype(np.float32)
+
+
+def real_fractions(config, reference, celltype_indices, celltypes):
+    """
+    NNLS fractions (see nnls_fractions) of the real samples against the mean
+    profiles of the cell-types of the preprocessed reference, on the genes of
+    both. Real samples are scaled to the mean total counts of a reference
+    cell, which keeps the least squares well conditioned.
+    """
+    X_real, samples, real_genes = read_real_samples(config)
+    genes = reference.var_names[reference.var_names.isin(real_genes)]
+    idx = reference.var_names.get_indexer(genes)
+    profiles, _ = celltype_profiles(reference.X, [celltype_indices])
+    means = profiles[0::2][:, idx]
+    X_real = X_real[:, real_genes.get_indexer(genes)]
+    X_real = X_real.astype(np.float64)
+    totals = np.asarray(X_real.sum(axis=1)).ravel()
+    scale = 1 / np.where(totals > 0, totals, 1) * means.sum(axis=1).mean()
+    X_real = diags(scale) @ X_real if issparse(X_real) else X_real * scale[:, None]
+    return pd.DataFrame(nnls_fractions(X_real, means), index=samples, columns=celltypes)
@@ -0,0 +1,170 @@
+import os
+import sys
+import atexit
+import subprocess
+import numpy as np
+import pandas as pd
+import h5py
+from scipy.sparse import csr_matrix, issparse, vstack
+from sklearn.decomposition import IncrementalPCA
+from anndata import AnnData
+import scanpy as sc
+import matplotlib.pyplot as plt
+from dissect.PropsSimulator.writer import read_rows
+
+try:
+    from anndata.io import read_elem
+except ImportError:
+    from anndata.experimental import read_elem
+
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "figures_worker.py")
+_workers = []
+
+
+def read_samples(folder, idx):
+    """
+    Samples idx (sorted) of simulated.h5ad in folder with their per cell-type
+    layers, reading only these rows of X, layers and the sampling plan.
+    """
+    from dissect.PropsSimulator.simulator import expression_layers
+
+    with h5py.File(os.path.join(folder, "simulated.h5ad"), "r") as f:
+        obs = read_elem(f["obs"])
+        adata = AnnData(
+            read_rows(f["X"], idx),
+            obs=obs.iloc[idx],
+            var=read_elem(f["var"]),
+            uns=read_elem(f["uns"]) if "uns" in f else None,
+        )
+        for key in f["obsm"]:
+            adata.obsm[key] = read_rows(f["obsm"][key], idx)
+        for layer in f["layers"]:
+            adata.layers[layer] = read_rows(f["layers"][layer], idx)
+    for celltype, layer in expression_layers(adata, folder).items():
+        adata.layers[celltype] = layer
+    return adata
+
+
+def n_samples(folder):
+    with h5py.File(os.path.join(folder, "simulated.h5ad"), "r") as f:
+        return f["obsm"]["cells"].shape[0]
+
+
+def component_figures(folder, max_samples=10000, seed=42):
+    """
+    PCA of at most max_samples simulated samples, and of the per cell-type
+    expression of the cell-types present in them. Only the subsampled rows are
+    read and layers stay sparse, see incremental_pca.
+    """
+    rng = np.random.default_rng(seed)
+    n = n_samples(folder)
+    idx = np.sort(rng.choice(n, min(max_samples, n), replace=False))
+    adata = read_samples(folder, idx)
+    celltypes = [col for col in adata.obs.columns if col not in ["ds", "batch"]]
+
+    sc.set_figure_params(dpi=200)
+    tmp = AnnData(adata.X.copy(), obs=adata.obs, var=adata.var)
+    sc.pp.normalize_total(tmp, target_sum=1e6)
+    sc.pp.log1p(tmp)
+    incremental_pca(tmp)
+    sc.pl.pca(tmp, color=adata.obs.columns, show=False)
+    plt.savefig(os.path.join(folder, "scatterplot_pca_simulated.pdf"))
+    if not len(adata.layers):
+        return
+
+    X = [
+        csr_matrix(adata.layers[celltype])[adata.obsm["cells"][:, j] > 0]
+        for j, celltype in enumerate(celltypes)
+    ]
+    tmp1 = AnnData(
+        vstack(X, format="csr"),
+        obs=pd.DataFrame(np.repeat(celltypes, [x.shape[0] for x in X]), columns=["Celltype"]),
+    )
+    del X
+    sc.pp.subsample(tmp1, fraction=0.5, random_state=42)
+    sc.pp.normalize_total(tmp1, target_sum=1e6)
+    sc.pp.log1p(tmp1)
+    incremental_pca(tmp1)
+    fig, ax = plt.subplots(nrows=1, ncols=1)
+    sc.pl.pca(tmp1, color="Celltype", show=False, ax=ax)
+    plt.savefig(
+        os.path.join(folder, "scatterplot_pca_simulated_celltypes.pdf"),
+        bbox_inches="tight",
+    )
+
+
+def incremental_pca(adata, n_comps=2, batch_size=2000):
+    """
+    First n_comps principal components of adata.X in obsm["X_pca"], fitted by
+    IncrementalPCA on batch_size rows at a time, so sparse X is only
+    densified per batch.
+    """
+    n_comps = min(n_comps, adata.n_obs, adata.n_vars)
+    batch_size = max(batch_size, n_comps)
+    pca = IncrementalPCA(n_components=n_comps, batch_size=batch_size)
+
+    def batches():
+        for i in range(0, adata.n_obs, batch_size):
+            batch = adata.X[i : i + batch_size]
+            yield batch.toarray() if issparse(batch) else np.asarray(batch)
+
+    for batch in batches():
+        # partial_fit needs at least n_comps rows, a short last batch is only transformed
+        if batch.shape[0] >= n_comps:
+            pca.partial_fit(batch)
+    adata.obsm["X_pca"] = np.concatenate([pca.transform(batch) for batch in batches()])
+    adata.uns["pca"] = {"variance_ratio": pca.explained_variance_ratio_, "variance": pca.explained_variance_}
+
+
+def start_component_figures(folder, config):
+    """
+    Renders component_figures of the simulation in folder in a separate
+    process and returns it (subprocess.Popen), so the pipeline goes on while
+    the figures are made. Its output goes to figures.log in folder, failures
+    are reported by check_component_figures.
+    """
+    with open(os.path.join(folder, "figures.log"), "w") as log:
+        worker = subprocess.Popen(
+            [
+                sys.executable,
+                WORKER,
+                folder,
+                str(config["simulation_params"]["n_figure_samples"]),
+                str(config["simulation_params"]["seed"]),
+            ],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    worker.folder = folder
+    # Called with the exit code once the figures are done, see check_component_figures
+    worker.on_done = None
+    _workers.append(worker)
+    return worker
+
+
+def check_component_figures(wait=False):
+    """
+    Reaps the finished figure processes (all of them, waiting for them, if
+    wait), reports the failed ones and calls their on_done. Returns the ones
+    still running.
+    """
+    for worker in list(_workers):
+        if wait and worker.poll() is None:
+            print("Waiting for the component figures of {}.".format(worker.folder))
+        code = worker.wait() if wait else worker.poll()
+        if code is None:
+            continue
+        _workers.remove(worker)
+        if code != 0:
+            print(
+                "Component figures of {} failed with exit code {}, see {}.".format(
+                    worker.folder, code, os.path.join(worker.folder, "figures.log")
+                )
+            )
+        if worker.on_done is not None:
+            worker.on_done(code)
+    return _workers
+
+
+atexit.register(check_component_figures, wait=True)
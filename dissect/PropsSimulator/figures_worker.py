@@ -0,0 +1,17 @@
+"""
+Entry point of the process rendering component figures, see
+start_component_figures. Run as a script so that dissect.PropsSimulator is
+imported without the dissect package __init__, which loads tensorflow.
+"""
+import os
+import sys
+import types
+
+if __name__ == "__main__":
+    sys.path.pop(0)
+    package = types.ModuleType("dissect")
+    package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    sys.modules["dissect"] = package
+    from dissect.PropsSimulator.figures import component_figures
+
+    component_figures(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
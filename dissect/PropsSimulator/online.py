@@ -0,0 +1,139 @@
+import os
+import copy
+import shutil
+from collections import deque
+import numpy as np
+from scipy.sparse import csr_matrix, diags, issparse
+from anndata import read_h5ad
+from dissect.PropsSimulator.sampling import (
+    DOWNSAMPLE_STREAM,
+    ONLINE_STREAM,
+    bulk_cells,
+    save_reference,
+    simulate_shard,
+    simulate_st_shard,
+    st_cells,
+    stream,
+    thin_counts,
+    worker_pool,
+)
+
+
+class OnlineSimulation(object):
+    """
+    Simulates training samples on the fly from the preprocessed reference of a
+    simulation with simulation_params online. Samples are normalized as
+    prepare_data normalizes stored simulations, on all genes of the reference,
+    and returned for genes only. Spatial samples are downsampled as stored
+    ones, if simulation_params downsample.
+    """
+
+    def __init__(self, config, genes):
+        self.config = config
+        adata = read_h5ad(os.path.join(config["experiment_folder"], "simulation", "reference.h5ad"))
+        self.X = csr_matrix(adata.X, dtype=np.float32) if issparse(adata.X) else np.asarray(adata.X, dtype=np.float32)
+        self.genes = adata.var_names.get_indexer(genes)
+        celltype_col = config["simulation_params"]["celltype_col"]
+        batch_col = config["simulation_params"]["batch_col"]
+        self.celltypes = np.sort(np.array(adata.obs[celltype_col].unique()))
+        # Cell indices per cell-type of every batch, each training batch is drawn from one of them
+        masks = [np.ones(adata.n_obs, dtype=bool)]
+        if batch_col in adata.obs.columns:
+            masks = [(adata.obs[batch_col] == batch).values for batch in adata.obs[batch_col].unique()]
+        self.folder = None
+        self.groups = [
+            [np.where(mask & (adata.obs[celltype_col] == celltype).values)[0] for celltype in self.celltypes]
+            for mask in masks
+        ]
+        self.n_groups = len(self.groups)
+        if not config["simulation_params"]["concentration"]:
+            config["simulation_params"]["concentration"] = np.ones(len(self.celltypes))
+        del adata
+
+    def batch(self, model, step, batch_size):
+        """
+        X (batch_size x genes) and proportions y of the training batch of step
+        for model, from their own random stream.
+        """
+        params = self.config["simulation_params"]
+        rng = np.random.default_rng(stream(params["seed"], ONLINE_STREAM, int(model), int(step)))
+        if params["type"] == "bulk":
+            props, cells = bulk_cells(
+                rng,
+                int(batch_size),
+                len(self.celltypes),
+                params["cells_per_sample"] or 100,
+                params["prop_sparse"],
+                params["concentration"],
+            )
+            fn = simulate_shard
+        else:
+            props, cells = st_cells(rng, int(batch_size), len(self.celltypes))
+            fn = simulate_st_shard
+        g = rng.integers(self.n_groups)
+        # Worker processes memory-map the reference from folder, see batches
+        reference = (self.X, self.groups[g]) if self.folder is None else (self.folder, g)
+        S, _, _ = fn(reference, cells, rng, False)
+        if params["type"] != "bulk" and params["downsample"]:
+            thin_rng = np.random.default_rng(stream(params["seed"], DOWNSAMPLE_STREAM, int(model), int(step)))
+            S = thin_counts(S, params["downsample"], thin_rng)
+
+        if self.config["deconv_params"]["normalize_simulated"] == "cpm":
+            totals = np.asarray(S.sum(axis=1), dtype=np.float32).ravel()
+            S = diags(1e6 / np.maximum(totals, 1e-12)) @ csr_matrix(S)
+        X = csr_matrix(S)[:, self.genes].toarray().astype(np.float32)
+
+        y = props.copy()
+        y[y < 0.005] = 0
+        y = y / y.sum(axis=1, keepdims=True)
+        return X, y.astype(np.float32)
+
+    def batches(self, model, batch_size, n_steps, n_jobs, folder):
+        """
+        Training batches (X, y) of steps 0 to n_steps - 1 for model, in order.
+        With n_jobs > 1 they are simulated in worker processes, which memory-map
+        the reference from folder, at most 2 * n_jobs steps ahead of training.
+        Batches only depend on model and step, not on n_jobs.
+        """
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        if not n_jobs or n_jobs == 1:
+            for step in range(n_steps):
+                yield self.batch(model, step, batch_size)
+            return
+
+        if os.path.exists(folder):
+            # Left behind by a run that was killed
+            shutil.rmtree(folder)
+        save_reference(self.X, self.groups, folder)
+        worker = copy.copy(self)
+        worker.X, worker.groups, worker.folder = None, None, folder
+        # Workers only need the simulation settings, deconv_params may hold tensorflow objects
+        worker.config = {
+            "simulation_params": self.config["simulation_params"],
+            "deconv_params": {"normalize_simulated": self.config["deconv_params"]["normalize_simulated"]},
+        }
+        try:
+            with worker_pool(n_jobs, _init_worker, (worker,)) as executor:
+                futures = deque()
+                for step in range(n_steps):
+                    futures.append(executor.submit(_worker_batch, model, step, batch_size))
+                    if len(futures) >= 2 * n_jobs:
+                        yield futures.popleft().result()
+                while futures:
+                    yield futures.popleft().result()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+# OnlineSimulation of a worker process, set once by _init_worker
+_simulation = None
+
+
+def _init_worker(simulation):
+    global _simulation
+    _simulation = simulation
+
+
+def _worker_batch(model, step, batch_size):
+    return _simulation.batch(model, step, batch_size)
@@ -0,0 +1,24 @@
+"""
+Initializer of the simulation worker processes, see worker_pool. Run by
+runpy.run_path in every worker before it unpickles any task, so that
+dissect.PropsSimulator is imported without the dissect and
+dissect.PropsSimulator package __init__, which load tensorflow, scanpy and
+matplotlib. initializer holds the pickled (initializer, initargs) of the pool.
+"""
+import os
+import sys
+import types
+import pickle
+
+if __name__ == "dissect_worker":
+    folder = os.path.dirname(os.path.abspath(__file__))
+    if "dissect" not in sys.modules:
+        package = types.ModuleType("dissect")
+        package.__path__ = [os.path.dirname(folder)]
+        sys.modules["dissect"] = package
+        subpackage = types.ModuleType("dissect.PropsSimulator")
+        subpackage.__path__ = [folder]
+        sys.modules["dissect.PropsSimulator"] = package.PropsSimulator = subpackage
+    function, args = pickle.loads(initializer)
+    if function is not None:
+        function(*args)
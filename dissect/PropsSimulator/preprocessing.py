@@ -0,0 +1,279 @@
+import numpy as np
+import pandas as pd
+import h5py
+import scanpy as sc
+from scipy.sparse import csr_matrix, issparse
+from anndata import AnnData
+from dissect.PropsSimulator.writer import read_rows
+
+try:
+    from anndata.io import read_elem
+except ImportError:
+    from anndata.experimental import read_elem
+
+
+# Rows compacted at a time, bounds the temporaries of preprocess_reference
+ROW_BLOCK = 10000
+
+
+def _row_sums(X, data=None):
+    """Row sums of X, or of data in the sparsity structure of sparse X."""
+    if data is not None:
+        X = csr_matrix((data, X.indices, X.indptr), shape=X.shape, copy=False)
+    return np.asarray(X @ np.ones(X.shape[1], dtype=np.float32)).ravel()
+
+
+def _column_sums(X, weights, data=None):
+    """Weighted column sums weights @ X, or of data in the sparsity structure of sparse X."""
+    if data is not None:
+        X = csr_matrix((data, X.indices, X.indptr), shape=X.shape, copy=False)
+    return np.asarray(weights.astype(np.float32) @ X).ravel()
+
+
+def _compact(X, cells, genes, scale):
+    """
+    Rows cells and columns genes of CSR X, scaled per row by scale. The
+    entries are moved to the front of the arrays of X block by block, so X is
+    overwritten and no second copy of it is made.
+    """
+    new_index = np.cumsum(genes) - 1
+    indptr = np.zeros(cells.sum() + 1, dtype=X.indptr.dtype)
+    nnz, row = 0, 0
+    for start in range(0, X.shape[0], ROW_BLOCK):
+        end = min(start + ROW_BLOCK, X.shape[0])
+        lo, hi = X.indptr[start], X.indptr[end]
+        rows = np.repeat(np.arange(start, end), np.diff(X.indptr[start : end + 1]))
+        keep = cells[rows] & genes[X.indices[lo:hi]]
+        k = keep.sum()
+        # nnz <= lo, the block is read before it is overwritten
+        X.data[nnz : nnz + k] = X.data[lo:hi][keep] * scale[rows[keep]]
+        X.indices[nnz : nnz + k] = new_index[X.indices[lo:hi][keep]]
+        counts = np.bincount(rows[keep] - start, minlength=end - start)[cells[start:end]]
+        indptr[row + 1 : row + 1 + len(counts)] = nnz + np.cumsum(counts)
+        row += len(counts)
+        nnz += k
+    return csr_matrix(
+        (X.data[:nnz], X.indices[:nnz], indptr), shape=(row, genes.sum()), copy=False
+    )
+
+
+def _read_array(element):
+    """Values of an obs or var column, also of files written without encoding attributes."""
+    if "encoding-type" in element.attrs:
+        return read_elem(element)
+    values = element[:]
+    return values.astype(str) if values.dtype.kind in "SO" else values
+
+
+def _read_column(group, col):
+    """Column col of the obs or var group of an .h5ad file, categorical columns of old files included."""
+    if "__categories" in group and col in group["__categories"]:
+        return pd.Categorical.from_codes(group[col][:], _read_array(group["__categories"][col]))
+    return _read_array(group[col])
+
+
+def _row_readable(X):
+    """Whether rows of X (an element of an open .h5ad file) can be read as slices, see read_rows."""
+    if isinstance(X, h5py.Dataset):
+        return True
+    return X.attrs.get("encoding-type") == "csr_matrix" and "shape" in X.attrs
+
+
+def read_reference_h5ad(path, columns, filter):
+    """
+    Reads the single-cell reference from the .h5ad file path: X, the obs
+    columns columns and the gene names, nothing else (other obs columns, obsm,
+    layers, raw). X is read in ROW_BLOCK rows twice, once to count the genes
+    of each cell and the cells (passing min_genes) of each gene, once to keep
+    the cells passing min_genes and the genes passing min_cells. The second
+    pass fills arrays allocated once from the counts of the first, so only one
+    copy of the filtered X is held. The result is ready for
+    preprocess_reference with prefiltered.
+    """
+    with h5py.File(path, "r") as f:
+        obs_index = _read_array(f["obs"][f["obs"].attrs["_index"]])
+        obs = pd.DataFrame(
+            {col: _read_column(f["obs"], col) for col in columns if col and col in f["obs"]},
+            index=pd.Index(obs_index).astype(str),
+        )
+        var_names = pd.Index(_read_array(f["var"][f["var"].attrs["_index"]])).astype(str)
+        X = f["X"]
+        if not _row_readable(X):
+            # e.g. CSC, X has to be read as a whole
+            X = csr_matrix(read_elem(X))
+        sparse = issparse(X) or isinstance(X, h5py.Group)
+        indptr = X["indptr"][:] if isinstance(X, h5py.Group) else None
+        n_obs = len(obs_index)
+
+        def rows(start):
+            end = min(start + ROW_BLOCK, n_obs)
+            if issparse(X):
+                return X[start:end]
+            return read_rows(X, np.arange(start, end), indptr)
+
+        cells = np.zeros(n_obs, dtype=bool)
+        n_cells = np.zeros(len(var_names), dtype=np.int64)
+        # Stored entries per gene of the kept cells, sizes the arrays of the filtered X
+        n_stored = np.zeros(len(var_names), dtype=np.int64)
+        for start in range(0, n_obs, ROW_BLOCK):
+            block = rows(start)
+            positive = block > 0
+            keep = np.asarray(positive.sum(axis=1)).ravel() >= filter["min_genes"]
+            cells[start : start + len(keep)] = keep
+            n_cells += np.asarray(positive[keep].sum(axis=0)).ravel()
+            if sparse:
+                n_stored += np.bincount(csr_matrix(block)[keep].indices, minlength=len(var_names))
+        genes = n_cells >= filter["min_cells"]
+
+        shape = (int(cells.sum()), int(genes.sum()))
+        if sparse:
+            nnz = int(n_stored[genes].sum())
+            index_dtype = np.int32 if max(nnz, shape[1]) < np.iinfo(np.int32).max else np.int64
+            data = np.empty(nnz, dtype=np.float32)
+            indices = np.empty(nnz, dtype=index_dtype)
+            new_indptr = np.zeros(shape[0] + 1, dtype=index_dtype)
+        else:
+            X_filtered = np.empty(shape, dtype=np.float32)
+        nnz, row = 0, 0
+        for start in range(0, n_obs, ROW_BLOCK):
+            block = rows(start)[cells[start : start + ROW_BLOCK]][:, genes]
+            n = block.shape[0]
+            if sparse:
+                block = csr_matrix(block)
+                data[nnz : nnz + block.nnz] = block.data
+                indices[nnz : nnz + block.nnz] = block.indices
+                new_indptr[row + 1 : row + 1 + n] = nnz + block.indptr[1:]
+                nnz += block.nnz
+            else:
+                X_filtered[row : row + n] = block
+            row += n
+    if sparse:
+        X_filtered = csr_matrix((data, indices, new_indptr), shape=shape, copy=False)
+    return AnnData(X_filtered, obs=obs[cells], var=pd.DataFrame(index=var_names[genes]))
+
+
+def preprocess_reference(adata, filter, prefiltered=False):
+    """
+    Filters and normalizes the single-cell reference, as sc.pp.filter_cells,
+    sc.pp.filter_genes, a cutoff on the percentage of mitochondrial counts,
+    sc.pp.normalize_per_cell and a cutoff on the log-mean expression of
+    sc.pp.highly_variable_genes would. All filters are boolean masks computed
+    from row and column sums of X, log-means are computed from the normalized
+    means without a log-transformed copy, and X is compacted once at the end,
+    in place if sparse. If prefiltered, the cells and genes of adata already
+    passed min_genes and min_cells (see read_reference_h5ad). Returns the
+    preprocessed AnnData.
+    """
+    adata.var_names_make_unique()
+    X = adata.X
+    sparse = issparse(X)
+    if sparse:
+        X = csr_matrix(X)
+    if prefiltered:
+        cells = np.ones(X.shape[0], dtype=bool)
+        genes = np.ones(X.shape[1], dtype=bool)
+    elif sparse:
+        positive = (X.data > 0).astype(np.float32)
+        cells = _row_sums(X, positive) >= filter["min_genes"]
+        genes = _column_sums(X, cells, positive) >= filter["min_cells"]
+        del positive
+    else:
+        cells = np.count_nonzero(X > 0, axis=1) >= filter["min_genes"]
+        genes = np.count_nonzero(X[cells] > 0, axis=0) >= filter["min_cells"]
+
+    # Percentage of mitochondrial counts among the remaining genes
+    mt = genes & np.asarray(adata.var_names.str.startswith("MT-"))
+    totals = np.asarray(X @ genes.astype(np.float32)).ravel()
+    mt_counts = np.asarray(X @ mt.astype(np.float32)).ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct_counts_mt = mt_counts / totals * 100
+    cells &= pct_counts_mt < filter["mt_cutoff"]
+    cells &= totals >= 1
+
+    # Every cell is scaled to the median of the total counts
+    scale = np.zeros(X.shape[0], dtype=np.float32)
+    scale[cells] = np.median(totals[cells]) / totals[cells]
+
+    # log1p of the normalized means, as in highly_variable_genes
+    means = _column_sums(X, scale) / cells.sum()
+    means[means == 0] = 1e-12
+    genes &= np.log1p(means) > filter["min_expr"]
+
+    if sparse:
+        X = _compact(X, cells, genes, scale)
+    else:
+        X = X[np.ix_(cells, genes)] * scale[cells, None]
+    obs = adata.obs[cells].copy()
+    for col in obs.columns:
+        if obs[col].dtype.name == "category":
+            obs[col] = obs[col].cat.remove_unused_categories()
+    return AnnData(X, obs=obs, var=adata.var[genes].copy())
+
+
+def _grid_boxes(E, side):
+    """Index of the box of side length side of a regular grid that every row of E falls in."""
+    cells = np.floor((E - E.min(axis=0)) / side).astype(np.int64)
+    return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+
+
+def geometric_sketch(E, n, rng, n_iter=30):
+    """
+    Indices of n rows of the embedding E chosen by geometric sketching: E is
+    covered by a grid of boxes, as large as possible while at least n boxes
+    are occupied, and cells are taken from every box in turn. Dense regions
+    thus give up most of their cells, rare states are kept.
+    """
+    if E.shape[0] <= n:
+        return np.arange(E.shape[0])
+    lo, hi = 0.0, float((E.max(axis=0) - E.min(axis=0)).max()) + 1e-6
+    for _ in range(n_iter):
+        side = (lo + hi) / 2
+        if _grid_boxes(E, side).max() + 1 >= n:
+            lo = side
+        else:
+            hi = side
+    boxes = _grid_boxes(E, lo) if lo > 0 else np.arange(E.shape[0])
+
+    # Rank of every cell within its box in random order, one cell per box per round
+    order = rng.permutation(E.shape[0])
+    order = order[np.argsort(boxes[order], kind="stable")]
+    starts = np.searchsorted(boxes[order], boxes[order])
+    rank = np.empty(E.shape[0], dtype=np.int64)
+    rank[order] = np.arange(E.shape[0]) - starts
+    tiebreak = rng.random(E.shape[0])
+    return np.sort(np.lexsort((tiebreak, rank))[:n])
+
+
+def sketch_reference(adata, columns, max_cells, rng, n_components=20):
+    """
+    Keeps at most max_cells cells of every group of cells sharing the values
+    of columns (cell-type and batch), chosen by geometric_sketch on a PCA of
+    the log-transformed reference. Returns the sketched AnnData and a report
+    of the cells per group before and after.
+    """
+    groups = adata.obs.groupby(columns, observed=True).indices
+    if all(len(idxs) <= max_cells for idxs in groups.values()):
+        keep = np.ones(adata.n_obs, dtype=bool)
+    else:
+        X = adata.X
+        if issparse(X):
+            X = csr_matrix((np.log1p(X.data), X.indices, X.indptr), shape=X.shape)
+        else:
+            X = np.log1p(X)
+        E = sc.pp.pca(X, n_comps=min(n_components, X.shape[0] - 1, X.shape[1] - 1), svd_solver="arpack")
+        del X
+        keep = np.zeros(adata.n_obs, dtype=bool)
+        for idxs in groups.values():
+            keep[idxs[geometric_sketch(E[idxs], max_cells, rng)]] = True
+
+    report = pd.DataFrame(
+        [
+            list(key if isinstance(key, tuple) else (key,)) + [len(idxs), keep[idxs].sum()]
+            for key, idxs in groups.items()
+        ],
+        columns=columns + ["n_cells", "n_kept"],
+    )
+    if keep.all():
+        return adata, report
+    return adata[keep].copy(), report
+
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse, vstack
+
+
+class RowStack(object):
+    """
+    Rows of several matrices (e.g. the X of several references with the same
+    genes) as one matrix, without concatenating them. Supports what the
+    simulation needs: shape, products a @ X (see rmatmul) and selecting rows.
+    """
+
+    def __init__(self, blocks):
+        if any(issparse(block) for block in blocks):
+            blocks = [csr_matrix(block, dtype=np.float32) for block in blocks]
+        self.blocks = blocks
+        self.offsets = np.cumsum([0] + [block.shape[0] for block in blocks])
+        self.shape = (int(self.offsets[-1]), blocks[0].shape[1])
+        self.dtype = blocks[0].dtype
+
+    def rmatmul(self, a):
+        """a @ X for a (n x rows of X), as the sum of the products of the columns of a of each block."""
+        a = csr_matrix(a)
+        S = None
+        for block, start, end in zip(self.blocks, self.offsets[:-1], self.offsets[1:]):
+            product = a[:, start:end] @ block
+            S = product if S is None else S + product
+        return S
+
+    def __getitem__(self, rows):
+        """Rows rows (indices) of X, in this order, as one matrix."""
+        rows = np.asarray(rows)
+        block_of = np.searchsorted(self.offsets, rows, side="right") - 1
+        order = np.argsort(block_of, kind="stable")
+        parts = [
+            self.blocks[b][rows[order][block_of[order] == b] - self.offsets[b]]
+            for b in np.unique(block_of)
+        ]
+        if not parts:
+            return self.blocks[0][:0]
+        stacked = vstack(parts, format="csr") if issparse(parts[0]) else np.concatenate(parts, axis=0)
+        # back from block order to the order of rows
+        return stacked[np.argsort(order, kind="stable")]
+
+
+class MultiReference(object):
+    """
+    Several preprocessed single-cell references simulated from as one: obs of
+    all cells (the needed columns only), the genes common to all references
+    and X as a RowStack of the references' X. Only what the simulator reads of
+    an AnnData reference (obs, var_names, X, n_obs) is provided. If some
+    references have batch_col, cells without a batch (references without the
+    column or missing values) are labeled with their reference, "reference<i>"
+    for the i-th one.
+    """
+
+    def __init__(self, references, columns, batch_col=None):
+        genes = references[0].var_names
+        for reference in references[1:]:
+            genes = genes[genes.isin(reference.var_names)]
+        for i, reference in enumerate(references):
+            if len(genes) != reference.n_vars or not (reference.var_names == genes).all():
+                references[i] = reference[:, genes].copy()
+                if issparse(references[i].X):
+                    # Reordered genes leave the indices of each row unsorted
+                    references[i].X.sort_indices()
+        if batch_col is not None and any(batch_col in reference.obs.columns for reference in references):
+            for i, reference in enumerate(references):
+                label = "reference{}".format(i)
+                if batch_col not in reference.obs.columns:
+                    reference.obs[batch_col] = label
+                else:
+                    batches = reference.obs[batch_col].astype(object)
+                    reference.obs[batch_col] = batches.where(batches.notna(), label)
+        self.references = references
+        self.var_names = genes
+        obs = []
+        for i, reference in enumerate(references):
+            part = reference.obs[[col for col in columns if col in reference.obs.columns]].copy()
+            part.index = ["{}-{}".format(name, i) for name in part.index]
+            obs.append(part)
+        self.obs = pd.concat(obs)
+        for col in self.obs.columns:
+            self.obs[col] = self.obs[col].astype(str).astype("category")
+        self.X = RowStack([reference.X for reference in references])
+        self.n_obs = self.X.shape[0]
@@ -0,0 +1,502 @@
+import os
+import runpy
+import pickle
+import shutil
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix, diags, issparse, vstack
+from dissect.PropsSimulator.references import RowStack
+
+
+# Independent random streams of a simulation, children of numpy.random.SeedSequence(seed)
+PROPS_STREAM = 0
+CELLS_STREAM = 1
+ONLINE_STREAM = 2
+DOWNSAMPLE_STREAM = 3
+CALIBRATION_STREAM = 4
+SKETCH_STREAM = 5
+
+# Rows per block when drawing proportions, bounds temporaries for very many samples
+BLOCK_SIZE = 1000000
+
+
+def stream(seed, *key):
+    """SeedSequence of one random stream of the simulation, e.g. stream(seed, PROPS_STREAM)."""
+    return np.random.SeedSequence(seed, spawn_key=key)
+
+
+def part_stream(seed, kind, offset=0):
+    """
+    SeedSequence of stream kind for the samples starting at offset. Samples
+    appended to a simulation (offset > 0) get their own streams, offset 0 keeps
+    those of a new simulation.
+    """
+    if offset:
+        return stream(seed, kind, offset)
+    return stream(seed, kind)
+
+
+def masked_dirichlet(rng, n_present, n_celltypes, block_size=BLOCK_SIZE):
+    """
+    Proportions of len(n_present) samples in which n_present[i] uniformly chosen
+    cell-types follow a flat Dirichlet and the others get a concentration of 1e-6.
+    The present cell-types are the first n_present[i] of a random permutation
+    (argsort of uniform draws), the Dirichlet draws are normalized gamma draws.
+    """
+    props = np.empty((len(n_present), n_celltypes), dtype=np.float32)
+    for start in range(0, len(n_present), block_size):
+        n = n_present[start : start + block_size]
+        order = np.argsort(rng.random((len(n), n_celltypes)), axis=1)
+        present = np.empty(order.shape, dtype=bool)
+        np.put_along_axis(present, order, np.arange(n_celltypes) < n[:, None], axis=1)
+        gamma = rng.standard_gamma(np.where(present, 1.0, 1e-6))
+        props[start : start + block_size] = gamma / gamma.sum(axis=1, keepdims=True)
+    return props
+
+
+def bulk_cells(rng, n_samples, n_celltypes, cells_per_sample, prop_sparse, concentration=None):
+    """
+    Proportions and cell counts per cell-type of n_samples bulk samples. The
+    first int(n_samples * (1 - prop_sparse)) contain all cell-types, with
+    Dirichlet(concentration) proportions, the others miss between 1 and
+    n_celltypes - 1 cell-types. Proportions below 1 / cells_per_sample are
+    dropped, the returned proportions are those of the rounded cell counts.
+    """
+    n_sparse = int(n_samples * prop_sparse)
+    if concentration is None:
+        concentration = np.ones(n_celltypes)
+    props_complete = rng.dirichlet(concentration, n_samples - n_sparse).astype(np.float32)
+    # Between 1 and n_celltypes - 1 cell-types are dropped per sparse sample
+    no_keep = rng.integers(1, n_celltypes, size=n_sparse)
+    props_sparse = masked_dirichlet(rng, n_celltypes - no_keep, n_celltypes)
+
+    props = np.concatenate([props_complete, props_sparse], axis=0)
+    props[props < 1 / cells_per_sample] = 0
+    props = props / props.sum(axis=1, keepdims=True)
+    cells = np.round(props * cells_per_sample, 0).astype(int)
+    # Update props to maintain summing to 1
+    return (cells / cells.sum(axis=1, keepdims=True)).astype(np.float32), cells
+
+
+def st_cells(rng, n_spots, n_celltypes):
+    """
+    Proportions and cell counts per cell-type of n_spots spots, with between
+    1 and 5 cell-types present per spot, made of 5 to 11 cells.
+    """
+    keep = np.minimum(rng.integers(1, 6, size=n_spots), n_celltypes)
+    props = masked_dirichlet(rng, keep, n_celltypes)
+    n_cells = rng.integers(5, 12, size=n_spots)
+    cells = np.round(props * n_cells[:, None]).astype(int)
+    # Recalculate proportions
+    return (cells / cells.sum(axis=1, keepdims=True)).astype(np.float32), cells
+
+
+def adaptive_cells(rng, fractions, n_cells, precision):
+    """
+    Proportions and cell counts per cell-type of len(n_cells) samples drawn
+    around fractions (estimated fractions of real samples): every sample
+    picks one row of fractions and follows a Dirichlet with mean close to it
+    and concentration precision. Proportions below 1 / n_cells are dropped,
+    the returned proportions are those of the rounded cell counts.
+    """
+    picks = rng.integers(0, len(fractions), size=len(n_cells))
+    gamma = rng.standard_gamma(precision * fractions[picks] + 1e-2)
+    props = gamma / gamma.sum(axis=1, keepdims=True)
+    props[props < 1 / n_cells[:, None]] = 0
+    props = props / props.sum(axis=1, keepdims=True)
+    cells = np.round(props * n_cells[:, None]).astype(int)
+    # At least one cell per sample
+    empty = cells.sum(axis=1) == 0
+    cells[empty, np.argmax(props[empty], axis=1)] = 1
+    return (cells / cells.sum(axis=1, keepdims=True)).astype(np.float32), cells
+
+
+def sampling_matrix(cells, celltype_indices, n_cells, rng):
+    """
+    Draws the reference cells of all samples at once. Returns one sparse
+    (n_samples x n_cells) matrix per cell-type holding how often each reference
+    cell was drawn into each sample. Cells are drawn uniformly with replacement.
+    """
+    n_samples = cells.shape[0]
+    samples = np.arange(n_samples)
+    matrices = []
+    for j, idxs in enumerate(celltype_indices):
+        counts = cells[:, j]
+        if counts.sum() > 0:
+            draws = idxs[rng.integers(0, len(idxs), size=counts.sum())]
+        else:
+            draws = np.zeros(0, dtype=int)
+        matrices.append(
+            csr_matrix(
+                (
+                    np.ones(len(draws), dtype=np.float32),
+                    (np.repeat(samples, counts), draws),
+                ),
+                shape=(n_samples, n_cells),
+            )
+        )
+    return matrices
+
+
+def _product(a, X):
+    S = X.rmatmul(a) if isinstance(X, RowStack) else a @ X
+    if issparse(S):
+        return csr_matrix(S, dtype=np.float32)
+    return np.asarray(S, dtype=np.float32)
+
+
+def combine(matrices):
+    """Sampling matrix of all cell-types, i.e. the sampling plan of the samples."""
+    a = matrices[0]
+    for m in matrices[1:]:
+        a = a + m
+    return a
+
+
+def pseudobulk(matrices, X, save_expr=False):
+    """
+    Sums the sampled cells of X (cells x genes) per sample. If save_expr, also
+    returns the per cell-type sums, i.e. the same product restricted to the
+    columns of each cell-type. The results are sparse if X is sparse.
+    """
+    if not save_expr:
+        return _product(combine(matrices), X), None
+
+    layers = [_product(m, X) for m in matrices]
+    total = layers[0]
+    for layer in layers[1:]:
+        total = total + layer
+    return total, layers
+
+
+def plan_layers(plan, X, celltype_indices, average=False):
+    """
+    Per cell-type layers from a sampling plan (samples x reference cells counts)
+    and the reference X it was sampled from: sums of the sampled cells of each
+    cell-type, or their means if average.
+    """
+    plan = csr_matrix(plan)
+    layers = []
+    for idxs in celltype_indices:
+        m = plan[:, idxs]
+        if average:
+            n_cells = np.asarray(m.sum(axis=1), dtype=np.float32).ravel()
+            m = diags(np.divide(1, n_cells, out=np.zeros_like(n_cells), where=n_cells > 0)) @ m
+        layers.append(csr_matrix(_product(m, X[idxs])))
+    return layers
+
+
+def thin_counts(S, fraction, rng):
+    """
+    Downsamples the counts of S (samples x genes) to fraction of their totals
+    in expectation: every count, rounded to an integer, is replaced by a
+    binomial draw of its reads kept with probability fraction. All nonzeros
+    are drawn at once, sparse S stays sparse.
+    """
+    if issparse(S):
+        S = csr_matrix(S, dtype=np.float32, copy=True)
+        S.data = rng.binomial(np.rint(S.data).astype(np.int64), fraction).astype(np.float32)
+        S.eliminate_zeros()
+        return S
+    return rng.binomial(np.rint(S).astype(np.int64), fraction).astype(np.float32)
+
+
+def stack(blocks):
+    """Stacks the row blocks of shards, sparse or dense."""
+    if issparse(blocks[0]):
+        return vstack(blocks, format="csr")
+    return np.concatenate(blocks, axis=0)
+
+
+def save_reference(X, groups, folder):
+    """
+    Writes the reference (X and, per group of cells such as a batch, the cell
+    indices of each cell-type) as .npy files which worker processes memory-map
+    instead of receiving copies.
+    """
+    os.makedirs(folder, exist_ok=True)
+    if isinstance(X, RowStack):
+        # One subfolder per block of several references
+        for i, block in enumerate(X.blocks):
+            os.makedirs(os.path.join(folder, "block{}".format(i)))
+            _save_matrix(block, os.path.join(folder, "block{}".format(i)))
+        np.save(os.path.join(folder, "n_blocks.npy"), np.array(len(X.blocks)))
+    else:
+        _save_matrix(X, folder)
+    np.save(
+        os.path.join(folder, "celltype_sizes.npy"),
+        np.array([[len(idxs) for idxs in celltype_indices] for celltype_indices in groups]),
+    )
+    np.save(
+        os.path.join(folder, "celltype_indices.npy"),
+        np.concatenate([idxs for celltype_indices in groups for idxs in celltype_indices]),
+    )
+    return folder
+
+
+def _save_matrix(X, folder):
+    if issparse(X):
+        X = csr_matrix(X)
+        # int32 indices when possible, scipy would otherwise downcast (and copy) them on load
+        idx_dtype = np.int32 if max(X.nnz, X.shape[1]) < np.iinfo(np.int32).max else np.int64
+        np.save(os.path.join(folder, "data.npy"), X.data)
+        np.save(os.path.join(folder, "indices.npy"), X.indices.astype(idx_dtype, copy=False))
+        np.save(os.path.join(folder, "indptr.npy"), X.indptr.astype(idx_dtype, copy=False))
+        np.save(os.path.join(folder, "shape.npy"), np.array(X.shape))
+    else:
+        np.save(os.path.join(folder, "X.npy"), np.ascontiguousarray(X))
+
+
+def _load_matrix(folder):
+    if os.path.exists(os.path.join(folder, "X.npy")):
+        return np.load(os.path.join(folder, "X.npy"), mmap_mode="r")
+    data, indices, indptr = [
+        np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+        for name in ["data", "indices", "indptr"]
+    ]
+    shape = tuple(np.load(os.path.join(folder, "shape.npy")))
+    return csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+_references = {}
+
+
+def load_reference(folder):
+    """Memory-maps a reference written by save_reference, once per process."""
+    if folder not in _references:
+        if os.path.exists(os.path.join(folder, "n_blocks.npy")):
+            n_blocks = int(np.load(os.path.join(folder, "n_blocks.npy")))
+            X = RowStack([_load_matrix(os.path.join(folder, "block{}".format(i))) for i in range(n_blocks)])
+        else:
+            X = _load_matrix(folder)
+        sizes = np.load(os.path.join(folder, "celltype_sizes.npy"))
+        indices = np.split(
+            np.load(os.path.join(folder, "celltype_indices.npy"), mmap_mode="r"),
+            np.cumsum(sizes.ravel())[:-1],
+        )
+        groups = [indices[g * sizes.shape[1] : (g + 1) * sizes.shape[1]] for g in range(sizes.shape[0])]
+        _references[folder] = (X, groups)
+    return _references[folder]
+
+
+def resolve_reference(reference):
+    """
+    X and the cell indices of each cell-type of a shard: given as they are in
+    the main process, as (folder, group) in worker processes.
+    """
+    if isinstance(reference[0], str):
+        X, groups = load_reference(reference[0])
+        return X, groups[reference[1]]
+    return reference
+
+
+def simulate_shard(reference, cells, seed, save_expr, save_plan=False):
+    """
+    Bulk pseudobulks of one shard of samples, see pseudobulk. Returns the
+    pseudobulks, the layers if save_expr and the sampling plan if save_plan.
+    """
+    X, celltype_indices = resolve_reference(reference)
+    rng = np.random.default_rng(seed)
+    matrices = sampling_matrix(cells, celltype_indices, X.shape[0], rng)
+    S, layers = pseudobulk(matrices, X, save_expr=save_expr)
+    return S, layers, combine(matrices) if save_plan else None
+
+
+def simulate_st_shard(reference, cells, seed, save_expr, save_plan=False):
+    """
+    Spots of one shard. Returns the sum of the sampled cells per spot, if
+    save_expr the mean expression of the sampled cells of each cell-type, from
+    one averaging matrix (sampling matrix scaled by 1 / n_cells) per cell-type,
+    and the sampling plan if save_plan.
+    """
+    X, celltype_indices = resolve_reference(reference)
+    rng = np.random.default_rng(seed)
+    # A spot can not hold more cells of a cell-type than the reference has
+    cells = np.minimum(cells, [len(idxs) for idxs in celltype_indices])
+    matrices = sampling_matrix(cells, celltype_indices, X.shape[0], rng)
+    S, _ = pseudobulk(matrices, X)
+    plan = combine(matrices) if save_plan else None
+    if not save_expr:
+        return S, None, plan
+
+    layers = []
+    for j, m in enumerate(matrices):
+        n_cells = cells[:, j].astype(np.float32)
+        scale = np.divide(1, n_cells, out=np.zeros_like(n_cells), where=n_cells > 0)
+        layers.append(csr_matrix(_product(diags(scale) @ m, X)))
+    return S, layers, plan
+
+
+def celltype_profiles(X, groups):
+    """
+    Mean and variance of the expression of every cell-type of every group, as
+    a reference for simulate_profile_shard: rows 2 * (g * n_celltypes + j) and
+    the next hold mean and variance of cell-type j of group g, the returned
+    groups hold these two row indices per cell-type.
+    """
+    profiles, profile_groups = [], []
+    for celltype_indices in groups:
+        profile_groups.append([])
+        for idxs in celltype_indices:
+            if len(idxs):
+                # Cells of one cell-type at a time, X is not copied as a whole
+                sub = X[np.asarray(idxs)]
+                sq = sub.multiply(sub) if issparse(sub) else np.square(sub)
+                mean = np.asarray(sub.mean(axis=0), dtype=np.float32).ravel()
+                mean_sq = np.asarray(sq.mean(axis=0), dtype=np.float32).ravel()
+            else:
+                mean = mean_sq = np.zeros(X.shape[1], dtype=np.float32)
+            profiles += [mean, np.maximum(mean_sq - mean**2, 0)]
+            profile_groups[-1].append(np.array([len(profiles) - 2, len(profiles) - 1]))
+    return np.array(profiles, dtype=np.float32), profile_groups
+
+
+def profile_draws(profiles, celltype_indices, cells, rng):
+    """
+    Sums of cells[:, j] cells of each cell-type j, drawn from a Gamma with the
+    mean and variance of such a sum (n * mean, n * variance of the cell-type
+    profile). Genes without variance get n * mean. Costs O(samples x genes)
+    per cell-type whatever the number of cells.
+    """
+    draws = []
+    for j, (mean_row, var_row) in enumerate(celltype_indices):
+        mean, var = profiles[mean_row], profiles[var_row]
+        fixed = (var <= 0) | (mean <= 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shape = np.where(fixed, 0, mean**2 / var).astype(np.float32)
+            scale = np.where(fixed, 0, var / mean).astype(np.float32)
+        n = cells[:, j, None].astype(np.float32)
+        draw = rng.standard_gamma(n * shape, dtype=np.float32) * scale
+        draws.append(draw + n * np.where(fixed, mean, 0).astype(np.float32))
+    return draws
+
+
+def simulate_profile_shard(reference, cells, seed, save_expr, save_plan=False):
+    """
+    Bulk pseudobulks of one shard drawn from cell-type profiles, see
+    celltype_profiles and profile_draws. There is no sampling plan, layers are
+    the per cell-type draws if save_expr.
+    """
+    profiles, celltype_indices = resolve_reference(reference)
+    draws = profile_draws(profiles, celltype_indices, cells, np.random.default_rng(seed))
+    return sum(draws), draws if save_expr else None, None
+
+
+def simulate_st_profile_shard(reference, cells, seed, save_expr, save_plan=False):
+    """Spots of one shard drawn from cell-type profiles, layers are the per cell-type means if save_expr."""
+    profiles, celltype_indices = resolve_reference(reference)
+    draws = profile_draws(profiles, celltype_indices, cells, np.random.default_rng(seed))
+    if not save_expr:
+        return sum(draws), None, None
+    layers = [csr_matrix(draw / np.maximum(cells[:, j, None], 1)) for j, draw in enumerate(draws)]
+    return sum(draws), layers, None
+
+
+def calibration(X, celltype_indices, profiles, profile_indices, cells, seed, exact_fn, profile_fn):
+    """
+    Compares samples of cells simulated by exact_fn (sampled reference cells)
+    and profile_fn (cell-type profiles), each from its own CALIBRATION_STREAM.
+    Returns per-gene agreement of their means and variances across samples,
+    of their total counts, and the correlation of log CPM of paired samples.
+    """
+    exact_seed, profile_seed = stream(seed, CALIBRATION_STREAM).spawn(2)
+    exact = exact_fn((X, celltype_indices), cells, exact_seed, False)[0]
+    exact = exact.toarray() if issparse(exact) else np.asarray(exact)
+    profile = profile_fn((profiles, profile_indices), cells, profile_seed, False)[0]
+
+    mean_e, mean_p = exact.mean(axis=0), profile.mean(axis=0)
+    var_e, var_p = exact.var(axis=0), profile.var(axis=0)
+    expressed, variable = mean_e > 0, var_e > 0
+    totals_e, totals_p = exact.sum(axis=1), profile.sum(axis=1)
+    log_e = np.log1p(exact / np.maximum(totals_e[:, None], 1e-12) * 1e6)
+    log_p = np.log1p(profile / np.maximum(totals_p[:, None], 1e-12) * 1e6)
+    log_e -= log_e.mean(axis=1, keepdims=True)
+    log_p -= log_p.mean(axis=1, keepdims=True)
+    paired = (log_e * log_p).sum(axis=1) / np.sqrt((log_e**2).sum(axis=1) * (log_p**2).sum(axis=1))
+    return {
+        "n_samples": cells.shape[0],
+        "median_relative_error_gene_means": float(
+            np.median(np.abs(mean_p[expressed] - mean_e[expressed]) / mean_e[expressed])
+        ),
+        "median_ratio_gene_variances": float(np.median(var_p[variable] / var_e[variable])),
+        "correlation_log_gene_means": float(np.corrcoef(np.log1p(mean_e), np.log1p(mean_p))[0, 1]),
+        "mean_ratio_total_counts": float(np.mean(totals_p / np.maximum(totals_e, 1e-12))),
+        "mean_correlation_paired_samples": float(np.nanmean(paired)),
+    }
+
+
+def worker_pool(n_jobs, initializer=None, initargs=()):
+    """
+    ProcessPoolExecutor of n_jobs spawned worker processes, forking after
+    numba/BLAS threads were started (scanpy) can deadlock. Every worker runs
+    pool_worker.py first, which keeps the package __init__ from being imported
+    with the tasks, and then initializer(*initargs).
+    """
+    return ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=runpy.run_path,
+        initargs=(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "pool_worker.py"),
+            {"initializer": pickle.dumps((initializer, initargs))},
+            "dissect_worker",
+        ),
+    )
+
+
+def iter_shards(fn, X, groups, cells, seed, chunk_size, n_jobs, folder, *args, offset=0, skip=0):
+    """
+    Runs fn on consecutive shards of chunk_size samples and yields (start, result)
+    in order of samples. groups holds the cell indices of each cell-type of
+    one or more groups of reference cells, e.g. batches. All samples are
+    simulated from every group, start is the row in the stacked output of all
+    groups. Every shard gets its own child of the CELLS_STREAM of seed, so
+    results only depend on seed and chunk_size, not on the number of workers.
+    With n_jobs > 1, shards of all groups run concurrently in worker processes
+    which memory-map the reference from folder. At most 2 * n_jobs shards are
+    in flight, which bounds memory of streamed results.
+
+    offset is the index of the first sample in the whole simulation, see
+    part_stream, and shards of rows before skip, written by an interrupted run,
+    are skipped.
+    """
+    n_samples = cells.shape[0]
+    bounds = [
+        (g, start, min(start + chunk_size, n_samples))
+        for g in range(len(groups))
+        for start in range(0, n_samples, chunk_size)
+    ]
+    seeds = part_stream(seed, CELLS_STREAM, offset).spawn(len(bounds))
+    bounds = [
+        (k, g, start, end)
+        for k, (g, start, end) in enumerate(bounds)
+        if g * n_samples + start >= skip
+    ]
+    if os.path.exists(folder):
+        # Left behind by a run that was killed
+        shutil.rmtree(folder)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if not n_jobs or n_jobs == 1 or len(bounds) <= 1:
+        for k, g, start, end in bounds:
+            yield g * n_samples + start, fn((X, groups[g]), cells[start:end], seeds[k], *args)
+        return
+
+    save_reference(X, groups, folder)
+    try:
+        with worker_pool(min(n_jobs, len(bounds))) as executor:
+            futures = deque()
+            for k, g, start, end in bounds:
+                futures.append(
+                    (g * n_samples + start, executor.submit(fn, (folder, g), cells[start:end], seeds[k], *args))
+                )
+                if len(futures) >= 2 * n_jobs:
+                    start, future = futures.popleft()
+                    yield start, future.result()
+            while futures:
+                start, future = futures.popleft()
+                yield start, future.result()
+    finally:
+        shutil.rmtree(folder)
@@ -10,7 +10,34 @@ import scanpy as sc
 import shutil
 from tqdm import tqdm
 import json
+import h5py
 import matplotlib.pyplot as plt
+from dissect.PropsSimulator.sampling import (
+    DOWNSAMPLE_STREAM,
+    PROPS_STREAM,
+    SKETCH_STREAM,
+    adaptive_cells,
+    bulk_cells,
+    calibration,
+    celltype_profiles,
+    iter_shards,
+    part_stream,
+    plan_layers,
+    simulate_profile_shard,
+    simulate_shard,
+    simulate_st_profile_shard,
+    simulate_st_shard,
+    st_cells,
+    stack,
+    stream,
+    thin_counts,
+)
+from dissect.PropsSimulator.preprocessing import preprocess_reference, read_reference_h5ad, sketch_reference
+from dissect.PropsSimulator.references import MultiReference, RowStack
+from dissect.PropsSimulator.adaptive import real_fractions
+from dissect.PropsSimulator.figures import check_component_figures, start_component_figures
+from dissect.PropsSimulator.writer import H5adWriter, read_progress, write_progress
+from dissect.utils.cache import Cache, config_hash, file_hash, link_files, unshare_file
 
 
 class Simulate(object):
@@ -19,13 +46,9 @@ class Simulate(object):
     
     def initialize(self, config):
         self.config = config
-        self.sc_adata = sc.read(config["simulation_params"]["scdata"])
         self.save_expr = config["simulation_params"]["save_expr"]
-        self.sc_adata.obs[config["simulation_params"]["celltype_col"]] = self.sc_adata.obs[config["simulation_params"]["celltype_col"]].astype(str)
-        self.sc_adata.obs[config["simulation_params"]["celltype_col"]].replace("/","_",regex=True,inplace=True)
-        self.sc_adata.obs[config["simulation_params"]["celltype_col"]] = self.sc_adata.obs[config["simulation_params"]["celltype_col"]].astype("category")
-        if "sparse" in str(type(self.sc_adata.X)):
-            self.sc_adata.X = np.array(self.sc_adata.X.todense())
+        self.reference_key = reference_key(config)
+        self.sc_adata, self.preprocessed, self.prefiltered = read_reference(config, self.reference_key)
         self.celltypes = np.sort(
             np.array(self.sc_adata.obs[config["simulation_params"]["celltype_col"]].unique())
         )
@@ -36,89 +59,47 @@ class Simulate(object):
             self.config["simulation_params"]["n_samples"] = 1000 * self.n_celltypes
         if not self.config["simulation_params"]["cells_per_sample"]:
             self.config["simulation_params"]["cells_per_sample"] = 100
-        self.n_sparse = int(self.config["simulation_params"]["n_samples"] * self.config["simulation_params"]["prop_sparse"])
-        self.n_complete = self.config["simulation_params"]["n_samples"] - self.n_sparse
+        self.simulation_folder, self.progress = setup_simulation_folder(self.config)
+        # Samples of this run, following those of previous runs when appending
+        self.offset = sum(self.progress["n_samples"][:-1])
+        n_samples = self.progress["n_samples"][-1]
+        n_adaptive = int(n_samples * self.config["simulation_params"]["adaptive"])
+        self.n_sparse = int((n_samples - n_adaptive) * self.config["simulation_params"]["prop_sparse"])
+        self.n_complete = n_samples - n_adaptive - self.n_sparse
+        rng = np.random.default_rng(
+            part_stream(self.config["simulation_params"]["seed"], PROPS_STREAM, self.offset)
+        )
 
-        ##### Complete
         if not self.config["simulation_params"]["concentration"]:
             self.config["simulation_params"]["concentration"] = np.ones(self.n_celltypes)
-        self.props_complete = np.random.dirichlet(
-            self.config["simulation_params"]["concentration"], self.n_complete
-        ).astype(np.float32)
-        self.min_prc = 1 / self.config["simulation_params"]["cells_per_sample"]
-        self.props_complete[self.props_complete < self.min_prc] = 0
-        # Re-normalize
-        self.props_complete = (
-            self.props_complete.T / self.props_complete.sum(axis=1)
-        ).T
-        self.cells_complete = self.props_complete * self.config["simulation_params"]["cells_per_sample"]
-        self.cells_complete = np.round(self.cells_complete, 0).astype(int)
-        # Update props to maintain summing to 1
-        self.props_complete = (
-            self.cells_complete.T / self.cells_complete.sum(axis=1)
-        ).T.astype(np.float32)
-
-        ##### Sparse
-        keep_sparse = np.ones((self.n_sparse, self.n_celltypes), dtype=np.float32)
-
-        no_keep = np.random.randint(1, self.n_celltypes, size=self.n_sparse)
-        no_keeps = []
-        for i in no_keep:
-            no_keeps.append(
-                np.random.choice(list(range(self.n_celltypes)), size=i, replace=False)
-            )
-
-        for i in range(len(no_keep)):
-            keep_sparse[i, no_keeps[i]] = 1e-6
-
-        self.props_sparse = np.zeros(
-            (self.n_sparse, self.n_celltypes), dtype=np.float32
+        self.props, self.cells = bulk_cells(
+            rng,
+            n_samples - n_adaptive,
+            self.n_celltypes,
+            self.config["simulation_params"]["cells_per_sample"],
+            self.config["simulation_params"]["prop_sparse"],
+            self.config["simulation_params"]["concentration"],
         )
-        for i in range(self.n_sparse):
-            self.props_sparse[i, :] = np.random.dirichlet(keep_sparse[i], 1)[0]
-
-        self.props_sparse[self.props_sparse < self.min_prc] = 0
-        self.props_sparse = (self.props_sparse.T / self.props_sparse.sum(axis=1)).T
-
-        self.cells_sparse = self.props_sparse * self.config["simulation_params"]["cells_per_sample"]
-        self.cells_sparse = np.round(self.cells_sparse, 0).astype(int)
-        self.props_sparse = (
-            self.cells_sparse.T / self.cells_sparse.sum(axis=1)
-        ).T.astype(np.float32)
-
-
-        if not os.path.exists(self.config["experiment_folder"]):
-            os.mkdir(self.config["experiment_folder"])
-        else:
-            from datetime import datetime
-
-            now = datetime.now()
-            date_time = now.strftime("%m.%d.%Y_%H.%M.%S")
-            name = "experiment_" + date_time
-            print(
-                "Specified experiment_folder {} already exists. Creating a new folder with name {}.".format(
-                    self.config["experiment_folder"], name
-                )
+        if n_adaptive:
+            props, cells = adaptive_samples(
+                self, rng, np.full(n_adaptive, self.config["simulation_params"]["cells_per_sample"])
+            )
+            self.props, self.cells = np.concatenate([self.props, props]), np.concatenate([self.cells, cells])
+        n_dirichlet = self.n_complete + self.n_sparse
+        self.props_complete, self.props_sparse = self.props[: self.n_complete], self.props[self.n_complete : n_dirichlet]
+        self.cells_complete, self.cells_sparse = self.cells[: self.n_complete], self.cells[self.n_complete : n_dirichlet]
+
+        if not self.offset:
+            fig = plt.figure()
+            ax = plt.boxplot(self.props_complete, labels=self.celltypes)  #
+            if self.n_celltypes>10:
+                plt.xticks(rotation=45, ha="right")
+            plt.ylabel("Proportion")
+            plt.title("Proportions of cell-types in generated samples")
+            plt.savefig(
+                os.path.join(self.simulation_folder, "boxplot_props_complete.pdf"),
+                bbox_inches="tight"
             )
-            self.config["experiment_folder"] = name
-            os.mkdir(self.config["experiment_folder"])
-
-        self.simulation_folder = os.path.join(self.config["experiment_folder"], "simulation")
-        if not os.path.exists(self.simulation_folder):
-            os.mkdir(self.simulation_folder)
-        else:
-            sys.exit(f"folder {self.simulation_folder} already exists.")
-
-        fig = plt.figure()
-        ax = plt.boxplot(self.props_complete, labels=self.celltypes)  #
-        if self.n_celltypes>10:
-            plt.xticks(rotation=45, ha="right")
-        plt.ylabel("Proportion")
-        plt.title("Proportions of cell-types in generated samples")
-        plt.savefig(
-            os.path.join(self.simulation_folder, "boxplot_props_complete.pdf"),
-            bbox_inches="tight"
-        )
         # fig = plt.figure()
         # ax = plt.boxplot(self.cells_complete, labels=self.celltypes)
         # plt.ylabel("Count")
@@ -142,190 +123,110 @@ class Simulate(object):
         #     os.path.join(self.simulation_folder, "boxplot_ncells_sparse.pdf")
         # )
 
-        self.props = np.concatenate([self.props_complete, self.props_sparse], axis=0)
-        self.cells = np.concatenate([self.cells_complete, self.cells_sparse], axis=0)
-
     def preprocess(self):
-        self.sc_adata.var_names_make_unique()
-        sc.pp.filter_cells(self.sc_adata, min_genes=self.config["simulation_params"]["filter"]["min_genes"])
-        sc.pp.filter_genes(self.sc_adata, min_cells=self.config["simulation_params"]["filter"]["min_cells"])
-
-        self.sc_adata.var["mt"] = self.sc_adata.var_names.str.startswith(
-            "MT-"
-        )  # annotate the group of mitochondrial genes as 'mt'
-        sc.pp.calculate_qc_metrics(
-            self.sc_adata, qc_vars=["mt"], percent_top=None, log1p=False, inplace=True
+        if self.preprocessed:
+            return
+        self.sc_adata = preprocess_reference(
+            self.sc_adata, self.config["simulation_params"]["filter"], prefiltered=self.prefiltered
         )
-        self.sc_adata = self.sc_adata[
-            self.sc_adata.obs.pct_counts_mt < self.config["simulation_params"]["filter"]["mt_cutoff"], :
-        ]
-        sc.pp.normalize_per_cell(self.sc_adata)
+        cache_reference(self.config, self.reference_key, self.sc_adata)
 
-        tmp = self.sc_adata.copy()
-        sc.pp.log1p(tmp)
-        sc.pp.highly_variable_genes(tmp)
-        heg = tmp.var[tmp.var.means > self.config["simulation_params"]["filter"]["min_expr"]].index
-        self.sc_adata = self.sc_adata[:, heg]
-        del tmp
-        del heg
+    def sketch(self):
+        self.sketch_report = sketch(self.config, self)
 
     def simulate(self, save=True):
-        adatas = {}
+        return self._simulate(
+            [celltype_indices(self.sc_adata.obs, self.config["simulation_params"]["celltype_col"], self.celltypes)],
+            save=save,
+        )
+
+    def _simulate(self, groups, batches=None, save=True):
+        """
+        Simulates self.cells from every group of reference cells (cell indices
+        per cell-type, e.g. of one batch) into one output, batch after batch.
+        """
         genes = self.sc_adata.var_names
-        for celltype in self.celltypes:
-            adatas[celltype] = np.array(
-                self.sc_adata[
-                    self.sc_adata.obs[self.config["simulation_params"]["celltype_col"]] == celltype
-                ].X
-            )
+        X = self.sc_adata.X
+        cells_obs = self.sc_adata.obs[[self.config["simulation_params"]["celltype_col"]]]
         self.sc_adata = None
+        save_plan = save and self.save_expr and self.config["simulation_params"]["expr_storage"] == "plan"
+        fn, reference, reference_groups = simulate_shard, X, groups
+        if self.config["simulation_params"]["mode"] == "profiles":
+            save_plan = False
+            fn = simulate_profile_shard
+            reference, reference_groups = profile_reference(
+                self, X, groups, simulate_shard, simulate_profile_shard, save
+            )
 
-        adata = AnnData(
-            np.zeros((self.config["simulation_params"]["n_samples"], len(genes))),
-            dtype=np.float32,
-            var=pd.DataFrame(index=genes),
-            obs=pd.DataFrame(self.props, columns=self.celltypes),
+        # One sparse (samples x cells) sampling matrix per cell-type and shard, pseudobulks in one product
+        shards = iter_shards(
+            fn,
+            reference,
+            reference_groups,
+            self.cells,
+            self.config["simulation_params"]["seed"],
+            self.config["simulation_params"]["chunk_size"],
+            self.config["simulation_params"]["n_jobs"],
+            os.path.join(self.simulation_folder, "reference_shared"),
+            self.save_expr and not save_plan,
+            save_plan,
+            offset=self.offset,
+            skip=skip_rows(self.progress, len(groups)) if save else 0,
         )
-        adata.obsm["cells"] = self.cells
-        if self.save_expr:
-            for celltype in self.celltypes:
-                adata.layers[celltype] = np.zeros(adata.X.shape, dtype=np.float32)
-        for i in tqdm(range(self.cells.shape[0])):
-            for j in range(self.n_celltypes):
-                cell_idxs = np.random.choice(
-                    range(adatas[self.celltypes[j]].shape[0]),
-                    self.cells[i][j],
-                    replace=True,
-                )
-                sample = adatas[self.celltypes[j]][cell_idxs, :].sum(axis=0)
-                if self.save_expr:
-                    adata.layers[self.celltypes[j]][i, :] = sample
-                if j == 0:
-                    total_sample = sample
-                else:
-                    total_sample = total_sample + sample
-            adata.X[i, :] = total_sample
-        
-        # convert to sparse matrices
-        if self.save_expr:
-            for i in range(self.n_celltypes):
-                adata.layers[self.celltypes[i]] = csr_matrix(adata.layers[self.celltypes[i]])
+        obs = simulation_obs(self.props, self.celltypes, batches, self.offset)
+        var = pd.DataFrame(index=genes)
+        cells = np.tile(self.cells, (len(groups), 1))
+        shared = shared_plan_reference(self) if save_plan else None
+        uns = plan_uns(self.config, average=False, shared=shared) if save_plan else None
         if save:
-            adata.write(os.path.join(self.simulation_folder, "simulated.h5ad"))
+            # Stream the shards to disk, only chunk_size samples are held in memory at a time
+            writer, first = open_writer(
+                self.simulation_folder, self.progress, len(groups), obs, var, {"cells": cells}, uns, self.config
+            )
+            if save_plan and shared is None and not os.path.exists(os.path.join(self.simulation_folder, "reference.h5ad")):
+                save_plan_reference(self.simulation_folder, X, cells_obs, var)
+            for start, (X_sim, layers, plan) in shards:
+                writer.write_chunk(first + start, *self._format_shard(X_sim, layers))
+                if save_plan:
+                    writer.write("obsm/sampling_plan", first + start, plan)
+                checkpoint(self.simulation_folder, self.progress, writer, first + start + X_sim.shape[0])
+            writer.close()
+            del X
+        else:
+            results = [result for start, result in shards]
+            del X
+            X_sim = stack([result[0] for result in results])
+            if self.save_expr:
+                layers = [stack([result[1][j] for result in results]) for j in range(self.n_celltypes)]
+            del results
+            X_sim, layers = self._format_shard(X_sim, layers if self.save_expr else None)
+            adata = AnnData(X_sim, var=var, obs=obs)
+            adata.obsm["cells"] = cells
+            if self.save_expr:
+                for celltype in self.celltypes:
+                    adata.layers[celltype] = layers[celltype]
+                del layers
 
+        if save:
             if self.config["simulation_params"]["generate_component_figures"]:
-                sc.set_figure_params(dpi=200)
-                tmp = adata.copy()
-                sc.pp.normalize_total(tmp, target_sum=1e6)
-                sc.pp.log1p(tmp)
-                sc.tl.pca(tmp)
-                sc.pl.pca(tmp, color=adata.obs.columns,show=False)
-                plt.savefig(
-                    os.path.join(
-                        self.simulation_folder, "scatterplot_pca_simulated.pdf"
-                    )
-                )
-                idxs = {}
-                celltypes_col = []
-                for j in range(self.n_celltypes):
-                    celltype = self.celltypes[j]
-                    idxs[celltype] = adata.obsm["cells"][:, j] > 0
-                    celltypes_col = celltypes_col + [celltype] * idxs[celltype].sum()
-                X = [
-                    adata.layers[celltype].toarray()[idxs[celltype], :]
-                    for celltype in self.celltypes
-                ]
-                tmp1 = AnnData(
-                    np.concatenate(X, axis=0),
-                    obs=pd.DataFrame(celltypes_col, columns=["Celltype"]),
-                )
-
-                sc.pp.subsample(tmp1, fraction=0.5, random_state=42)
-                sc.pp.normalize_total(tmp1, target_sum=1e6)
-                sc.pp.log1p(tmp1)
-                sc.tl.pca(tmp1)
-                fig, ax = plt.subplots(nrows=1, ncols=1)
-                sc.pl.pca(
-                    tmp1, color="Celltype", show=False, ax=ax
-                )
-                plt.savefig(
-                    os.path.join(
-                        self.simulation_folder,
-                        "scatterplot_pca_simulated_celltypes.pdf",
-                    ),
-                    bbox_inches="tight",
-                )
+                self.figure_worker = start_component_figures(self.simulation_folder, self.config)
         else:
             return adata
 
-    def simulate_per_batch(self, save=True):
-        adata_orig = self.sc_adata.copy()
-        adatas = []
-        for batch in self.batches:
-            self.sc_adata = adata_orig[
-                adata_orig.obs[self.config["simulation_params"]["batch_col"]] == batch
-            ]
-            adatas.append(self.simulate(save=False))
-        adata = adatas[0].concatenate(adatas[1:], batch_categories=self.batches)
-
-        # adata.write(os.path.join(self.simulation_folder, "simulated.h5ad"))
+    def _format_shard(self, X_sim, layers):
+        """Output formats of a shard: X dense if dense_output, layers as {celltype: CSR}."""
+        if self.config["simulation_params"]["dense_output"] and issparse(X_sim):
+            X_sim = X_sim.toarray()
+        if layers is not None:
+            layers = {celltype: csr_matrix(layer) for celltype, layer in zip(self.celltypes, layers)}
+        return X_sim, layers
 
-        if save:
-            adata.write(os.path.join(self.simulation_folder, "simulated.h5ad"))
-            
-            if self.config["simulation_params"]["generate_component_figures"]:
-                sc.set_figure_params(dpi=200)
-                tmp = adata.copy()
-                sc.pp.normalize_total(tmp, target_sum=1e6)
-                sc.pp.log1p(tmp)
-                sc.tl.pca(tmp)
-                sc.pl.pca(tmp, color=adata.obs.columns, show=False)
-                plt.savefig(
-                    os.path.join(
-                        self.simulation_folder, "scatterplot_pca_simulated.pdf"
-                    )
-                )
-                sc.set_figure_params(dpi=200)
-                tmp = adata.copy()
-                sc.pp.normalize_total(tmp, target_sum=1e6)
-                sc.pp.log1p(tmp)
-                sc.tl.pca(tmp)
-                sc.pl.pca(tmp, color=adata.obs.columns, show=False)
-                plt.savefig(
-                    os.path.join(
-                        self.simulation_folder, "scatterplot_pca_simulated.pdf"
-                    )
-                )
-                idxs = {}
-                celltypes_col = []
-                for j in range(self.n_celltypes):
-                    celltype = self.celltypes[j]
-                    idxs[celltype] = adata.obsm["cells"][:, j] > 0
-                    celltypes_col = celltypes_col + [celltype] * idxs[celltype].sum()
-                X = [
-                    adata.layers[celltype].toarray()[idxs[celltype], :]
-                    for celltype in self.celltypes
-                ]
-                tmp1 = AnnData(
-                    np.concatenate(X, axis=0),
-                    obs=pd.DataFrame(celltypes_col, columns=["Celltype"]),
-                )
-
-                sc.pp.subsample(tmp1, fraction=0.5, random_state=42)
-                sc.pp.normalize_total(tmp1, target_sum=1e6)
-                sc.pp.log1p(tmp1)
-                sc.tl.pca(tmp1)
-                fig, ax = plt.subplots(nrows=1, ncols=1)
-                sc.pl.pca(
-                    tmp1, color="Celltype", show=False, ax=ax
-                )
-                plt.savefig(
-                    os.path.join(
-                        self.simulation_folder,
-                        "scatterplot_pca_simulated_celltypes.pdf",
-                    ),
-                    bbox_inches="tight",
-                )
+    def simulate_per_batch(self, save=True):
+        return self._simulate(
+            batch_groups(self.sc_adata.obs, self.config, self.celltypes, self.batches),
+            self.batches,
+            save=save,
+        )
 
 class Simulate_st(object):
     def __init__(self):
@@ -333,78 +234,37 @@ class Simulate_st(object):
 
     def initialize(self, config):
         self.config = config
-        self.sc_adata = sc.read(config["simulation_params"]["scdata"])
         self.save_expr = config["simulation_params"]["save_expr"]
-        self.sc_adata.obs[config["simulation_params"]["celltype_col"]] = self.sc_adata.obs[config["simulation_params"]["celltype_col"]].astype(str)
-        self.sc_adata.obs[config["simulation_params"]["celltype_col"]].replace("/","_",regex=True,inplace=True)
-        self.sc_adata.obs[config["simulation_params"]["celltype_col"]] = self.sc_adata.obs[config["simulation_params"]["celltype_col"]].astype("category")
+        self.reference_key = reference_key(config)
+        self.sc_adata, self.preprocessed, self.prefiltered = read_reference(config, self.reference_key)
         self.celltypes = np.sort(
             np.array(self.sc_adata.obs[config["simulation_params"]["celltype_col"]].unique())
         )
         self.n_celltypes = len(self.celltypes)
-        
-        self.celltype_indices = {}
-        for ct in self.celltypes:
-            mask = self.sc_adata.obs[config["simulation_params"]["celltype_col"]] == ct
-            self.celltype_indices[ct] = np.where(mask)[0]
 
     def generate_props(self):
         if not self.config["simulation_params"]["n_samples"]:
             self.config["simulation_params"]["n_samples"] = 1000 * self.n_celltypes
-        self.n_sparse = self.config["simulation_params"]["n_samples"]
-
-        ##### Sparse
-        keep_sparse = np.ones((self.n_sparse, self.n_celltypes), dtype=np.float32)
-        keep = np.random.randint(1, 6, size=self.n_sparse)
-        keeps = []
-        for i in keep:
-            keeps.append(
-                np.random.choice(list(range(self.n_celltypes)), size=i, replace=False)
-            )
-
-        for i in range(len(keep)):
-            idx_exclude = np.ones(self.n_celltypes, dtype=bool)
-            idx_exclude[keeps[i]] = False
-            keep_sparse[i, idx_exclude] = 1e-6
-
-        # Generate proportions using Dirichlet
-        props = np.zeros((self.n_sparse, self.n_celltypes), dtype=np.float32)
-        for i in range(self.n_sparse):
-            props[i, :] = np.random.dirichlet(keep_sparse[i], 1)[0]
+        self._setup_folders()
+        n_adaptive = int(self.progress["n_samples"][-1] * self.config["simulation_params"]["adaptive"])
+        self.n_sparse = self.progress["n_samples"][-1] - n_adaptive
 
-        cells = np.zeros_like(props, dtype=int)
-        for i in range(props.shape[0]):
-            n_cells = np.random.choice(list(range(5, 12)), size=1, replace=False)[0]
-            cells[i] = np.round(props[i] * n_cells).astype(int)
+        rng = np.random.default_rng(
+            part_stream(self.config["simulation_params"]["seed"], PROPS_STREAM, self.offset)
+        )
 
-        # Recalculate proportions
-        self.props = (cells.T / cells.sum(axis=1)).T.astype(np.float32)
-        self.cells = cells
+        self.props, self.cells = st_cells(rng, self.n_sparse, self.n_celltypes)
+        if n_adaptive:
+            props, cells = adaptive_samples(self, rng, rng.integers(5, 12, size=n_adaptive))
+            self.props, self.cells = np.concatenate([self.props, props]), np.concatenate([self.cells, cells])
 
-        self._setup_folders()
-        self._create_plots()
+        if not self.offset:
+            self._create_plots()
 
     def _setup_folders(self):
-        if not os.path.exists(self.config["experiment_folder"]):
-            os.mkdir(self.config["experiment_folder"])
-        else:
-            from datetime import datetime
-            now = datetime.now()
-            date_time = now.strftime("%m.%d.%Y_%H.%M.%S")
-            name = "experiment_" + date_time
-            print(
-                "Specified experiment_folder {} already exists. Creating a new folder with name {}.".format(
-                    self.config["experiment_folder"], name
-                )
-            )
-            self.config["experiment_folder"] = name
-            os.mkdir(self.config["experiment_folder"])
-
-        self.simulation_folder = os.path.join(self.config["experiment_folder"], "simulation")
-        if not os.path.exists(self.simulation_folder):
-            os.mkdir(self.simulation_folder)
-        else:
-            sys.exit(f"folder {self.simulation_folder} already exists.")
+        self.simulation_folder, self.progress = setup_simulation_folder(self.config)
+        # Spots of this run, following those of previous runs when appending
+        self.offset = sum(self.progress["n_samples"][:-1])
 
     def _create_plots(self):
         fig = plt.figure()
@@ -419,159 +279,563 @@ class Simulate_st(object):
         )
 
     def preprocess(self):
-        self.sc_adata.var_names_make_unique()
-        sc.pp.filter_cells(self.sc_adata, min_genes=self.config["simulation_params"]["filter"]["min_genes"])
-        sc.pp.filter_genes(self.sc_adata, min_cells=self.config["simulation_params"]["filter"]["min_cells"])
-
-        self.sc_adata.var["mt"] = self.sc_adata.var_names.str.startswith(
-            "MT-"
-        )
-        sc.pp.calculate_qc_metrics(
-            self.sc_adata, qc_vars=["mt"], percent_top=None, log1p=False, inplace=True
+        if self.preprocessed:
+            return
+        self.sc_adata = preprocess_reference(
+            self.sc_adata, self.config["simulation_params"]["filter"], prefiltered=self.prefiltered
         )
-        self.sc_adata = self.sc_adata[
-            self.sc_adata.obs.pct_counts_mt < self.config["simulation_params"]["filter"]["mt_cutoff"], :
-        ]
-        sc.pp.normalize_per_cell(self.sc_adata)
+        cache_reference(self.config, self.reference_key, self.sc_adata)
 
-        tmp = self.sc_adata.copy()
-        sc.pp.log1p(tmp)
-        sc.pp.highly_variable_genes(tmp)
-        heg = tmp.var[tmp.var.means > self.config["simulation_params"]["filter"]["min_expr"]].index
-        self.sc_adata = self.sc_adata[:, heg]
-        del tmp
-        del heg
+    def sketch(self):
+        self.sketch_report = sketch(self.config, self)
 
     def simulate(self, save=True):
-        genes = self.sc_adata.var_names
-        n_cells_total = self.sc_adata.shape[0]  
-        n_samples = self.cells.shape[0]         
-        
-        a = csr_matrix((n_cells_total, n_samples), dtype=np.float32)
-        
-        if self.save_expr:
-            ct_arr = {}
-            
-        for sample_num in tqdm(range(n_samples)):
-            if self.save_expr:
-                ct_arr[sample_num] = {}
-                
-            row_indices = []
-            col_indices = []
-            data_values = []
-            
-            for ct_idx, ct in enumerate(self.celltypes):
-                cell_num = self.cells[sample_num, ct_idx]
-                if cell_num > 0:
-                    valid_indices = self.celltype_indices[ct]
-                    
-                    cell_num = min(cell_num, len(valid_indices))
-                    
-                    if cell_num > 0:
-                        sampled_indices = np.random.choice(valid_indices, cell_num, replace=True)
-                        row_indices.extend(sampled_indices)
-                        col_indices.extend([sample_num] * cell_num)
-                        data_values.extend([1.0] * cell_num)
-                        
-                        if self.save_expr:
-                            ct_arr[sample_num][ct] = self.sc_adata[sampled_indices].to_df().mean(0)
-            
-            if row_indices:
-                max_idx = max(row_indices)
-                if max_idx >= n_cells_total:
-                    print(f"Warning: Found index {max_idx} exceeding {n_cells_total} at sample {sample_num}")
-                    continue
-                    
-                new_data = csr_matrix(
-                    (data_values, (row_indices, col_indices)),
-                    shape=(n_cells_total, n_samples)
-                )
-                a = a + new_data
-
-        S = self.sc_adata.X.T * a
-        
-        adata = AnnData(
-            S.T,
-            var=pd.DataFrame(index=genes),
-            obs=pd.DataFrame(self.props, columns=self.celltypes),
+        return self._simulate(
+            [celltype_indices(self.sc_adata.obs, self.config["simulation_params"]["celltype_col"], self.celltypes)],
+            save=save,
         )
-        adata.obsm["cells"] = self.cells
-        
-        if self.save_expr:
-            for ct in self.celltypes:
-                layer_data = np.zeros((adata.shape[0], adata.shape[1]), dtype=np.float32)
-                for i in ct_arr:
-                    if ct in ct_arr[i]:
-                        layer_data[i] = ct_arr[i][ct]
-                adata.layers[ct] = csr_matrix(layer_data)
-
-        if self.config["simulation_params"]["downsample"]:
-            sc.pp.downsample_counts(
-                adata, counts_per_cell=self.config["simulation_params"]["downsample"] * adata.X.sum(1)
+
+    def _simulate(self, groups, batches=None, save=True):
+        """Simulates self.cells from every group of reference cells, see Simulate._simulate."""
+        genes = self.sc_adata.var_names
+        save_plan = save and self.save_expr and self.config["simulation_params"]["expr_storage"] == "plan"
+        fn, reference, reference_groups = simulate_st_shard, self.sc_adata.X, groups
+        if self.config["simulation_params"]["mode"] == "profiles":
+            save_plan = False
+            fn = simulate_st_profile_shard
+            reference, reference_groups = profile_reference(
+                self, self.sc_adata.X, groups, simulate_st_shard, simulate_st_profile_shard, save
             )
 
+        shards = iter_shards(
+            fn,
+            reference,
+            reference_groups,
+            self.cells,
+            self.config["simulation_params"]["seed"],
+            self.config["simulation_params"]["chunk_size"],
+            self.config["simulation_params"]["n_jobs"],
+            os.path.join(self.simulation_folder, "reference_shared"),
+            self.save_expr and not save_plan,
+            save_plan,
+            offset=self.offset,
+            skip=skip_rows(self.progress, len(groups)) if save else 0,
+        )
+        obs = simulation_obs(self.props, self.celltypes, batches, self.offset)
+        var = pd.DataFrame(index=genes)
+        cells = np.tile(self.cells, (len(groups), 1))
+        shared = shared_plan_reference(self) if save_plan else None
+        uns = plan_uns(self.config, average=True, shared=shared) if save_plan else None
+
         if save:
-            adata.write(os.path.join(self.simulation_folder, "simulated.h5ad"))
+            # Stream the shards to disk, only chunk_size spots are held in memory at a time
+            writer, first = open_writer(
+                self.simulation_folder, self.progress, len(groups), obs, var, {"cells": cells}, uns, self.config
+            )
+            if save_plan and shared is None and not os.path.exists(os.path.join(self.simulation_folder, "reference.h5ad")):
+                save_plan_reference(
+                    self.simulation_folder,
+                    self.sc_adata.X,
+                    self.sc_adata.obs[[self.config["simulation_params"]["celltype_col"]]],
+                    var,
+                )
+            for start, (S, layers, plan) in shards:
+                if layers is not None:
+                    layers = dict(zip(self.celltypes, layers))
+                writer.write_chunk(first + start, self._downsample(S, first + start), layers)
+                if save_plan:
+                    writer.write("obsm/sampling_plan", first + start, plan)
+                checkpoint(self.simulation_folder, self.progress, writer, first + start + S.shape[0])
+            writer.close()
             if self.config["simulation_params"]["generate_component_figures"]:
-                self._generate_component_figures(adata)
+                self.figure_worker = start_component_figures(self.simulation_folder, self.config)
         else:
+            results = [result for start, result in shards]
+            adata = AnnData(
+                self._downsample(stack([result[0] for result in results]), 0),
+                var=var,
+                obs=obs,
+            )
+            adata.obsm["cells"] = cells
+
+            if self.save_expr:
+                for j, ct in enumerate(self.celltypes):
+                    adata.layers[ct] = stack([result[1][j] for result in results])
+            del results
             return adata
 
-    def _generate_component_figures(self, adata):
-        sc.set_figure_params(dpi=200)
-        tmp = adata.copy()
-        sc.pp.normalize_total(tmp, target_sum=1e6)
-        sc.pp.log1p(tmp)
-        sc.tl.pca(tmp)
-        sc.pl.pca(tmp, color=adata.obs.columns, show=False)
-        plt.savefig(
-            os.path.join(
-                self.simulation_folder, "scatterplot_pca_simulated.pdf"
-            )
+    def _downsample(self, S, start):
+        """Thins the counts of the spots starting at row start, from their own DOWNSAMPLE_STREAM."""
+        if not self.config["simulation_params"]["downsample"]:
+            return S
+        rng = np.random.default_rng(stream(self.config["simulation_params"]["seed"], DOWNSAMPLE_STREAM, start))
+        return thin_counts(S, self.config["simulation_params"]["downsample"], rng)
+
+    def simulate_per_batch(self, save=True):
+        return self._simulate(
+            batch_groups(self.sc_adata.obs, self.config, self.celltypes, self.batches),
+            self.batches,
+            save=save,
         )
 
-        idxs = {}
-        celltypes_col = []
-        for j, celltype in enumerate(self.celltypes):
-            idxs[celltype] = adata.obsm["cells"][:, j] > 0
-            celltypes_col.extend([celltype] * idxs[celltype].sum())
 
-        X = [adata.layers[celltype].toarray()[idxs[celltype], :] for celltype in self.celltypes]
-        tmp1 = AnnData(
-            np.concatenate(X, axis=0),
-            obs=pd.DataFrame(celltypes_col, columns=["Celltype"]),
+def adaptive_samples(sim, rng, n_cells):
+    """
+    Proportions and cell counts of len(n_cells) samples of sim drawn around
+    the NNLS fractions of the real samples (see real_fractions and
+    adaptive_cells), which a new simulation writes to real_fractions.txt.
+    """
+    params = sim.config["simulation_params"]
+    fractions = real_fractions(
+        sim.config,
+        sim.sc_adata,
+        celltype_indices(sim.sc_adata.obs, params["celltype_col"], sim.celltypes),
+        sim.celltypes,
+    )
+    if not sim.offset:
+        fractions.to_csv(os.path.join(sim.simulation_folder, "real_fractions.txt"), sep="\t")
+    return adaptive_cells(rng, fractions.values, n_cells, params["adaptive_precision"])
+
+
+def sketch(config, sim):
+    """
+    Keeps at most max_cells_per_celltype cells of every cell-type (per batch)
+    of the reference of sim, see sketch_reference. Returns the report of
+    kept cells, None if there is no maximum.
+    """
+    max_cells = config["simulation_params"]["max_cells_per_celltype"]
+    if not max_cells:
+        return None
+    columns = [
+        col
+        for col in [config["simulation_params"]["celltype_col"], config["simulation_params"]["batch_col"]]
+        if col in sim.sc_adata.obs.columns
+    ]
+    n_cells = sim.sc_adata.n_obs
+    rng = np.random.default_rng(stream(config["simulation_params"]["seed"], SKETCH_STREAM))
+    if isinstance(sim.sc_adata, MultiReference):
+        # Every reference is sketched on its own, on the columns it has (e.g. without batch_col)
+        references, reports = [], []
+        for i, reference in enumerate(sim.sc_adata.references):
+            reference_columns = [col for col in columns if col in reference.obs.columns]
+            reference, report = sketch_reference(reference, reference_columns, max_cells, rng)
+            report.insert(0, "reference", i)
+            references.append(reference)
+            reports.append(report)
+        sim.sc_adata = MultiReference(references, columns)
+        report = pd.concat(reports, ignore_index=True)
+    else:
+        sim.sc_adata, report = sketch_reference(sim.sc_adata, columns, max_cells, rng)
+    print("Sketching kept {} of {} reference cells.".format(sim.sc_adata.n_obs, n_cells))
+    return report
+
+
+def reference_key(config, scdata=None):
+    """
+    Key of the preprocessed reference in the reference cache, a hash of the
+    content of scdata (by default the one of config), celltype_col, batch_col
+    and the filter settings. None if caching is disabled or scdata is a list
+    of references, which are cached one by one.
+    """
+    scdata = scdata or config["simulation_params"]["scdata"]
+    if not config["simulation_params"]["cache_dir"] or isinstance(scdata, (list, tuple)):
+        return None
+    return config_hash(
+        file_hash(scdata),
+        config["simulation_params"]["celltype_col"],
+        config["simulation_params"]["batch_col"],
+        config["simulation_params"]["filter"],
+    )
+
+
+def read_reference(config, key=None, scdata=None):
+    """
+    Reads the single-cell reference scdata, by default the one of config.
+    Returns the AnnData, whether it is already preprocessed, i.e. was found in
+    the reference cache under key, and whether it is already filtered by
+    min_genes and min_cells. Of .h5ad files, only X, the cell-type and batch
+    columns and the genes passing min_cells are read, see read_reference_h5ad.
+    A list of references is read by read_references.
+    """
+    scdata = scdata or config["simulation_params"]["scdata"]
+    if isinstance(scdata, (list, tuple)):
+        return read_references(config, scdata), True, True
+    if key is not None:
+        path = Cache(config["simulation_params"]["cache_dir"]).entry(key)
+        if path is not None:
+            print("Loading preprocessed reference from cache {}".format(path))
+            return sc.read(os.path.join(path, "reference.h5ad")), True, True
+
+    prefiltered = scdata.endswith(".h5ad")
+    if prefiltered:
+        adata = read_reference_h5ad(
+            scdata,
+            [config["simulation_params"]["celltype_col"], config["simulation_params"]["batch_col"]],
+            config["simulation_params"]["filter"],
         )
-
-        sc.pp.subsample(tmp1, fraction=0.5, random_state=42)
-        sc.pp.normalize_total(tmp1, target_sum=1e6)
-        sc.pp.log1p(tmp1)
-        sc.tl.pca(tmp1)
-        fig, ax = plt.subplots(nrows=1, ncols=1)
-        sc.pl.pca(tmp1, color="Celltype", show=False, ax=ax)
-        plt.savefig(
-            os.path.join(
-                self.simulation_folder,
-                "scatterplot_pca_simulated_celltypes.pdf",
-            ),
-            bbox_inches="tight",
+    else:
+        adata = sc.read(scdata)
+    adata.obs[config["simulation_params"]["celltype_col"]] = adata.obs[config["simulation_params"]["celltype_col"]].astype(str)
+    adata.obs[config["simulation_params"]["celltype_col"]].replace("/","_",regex=True,inplace=True)
+    adata.obs[config["simulation_params"]["celltype_col"]] = adata.obs[config["simulation_params"]["celltype_col"]].astype("category")
+    if issparse(adata.X):
+        adata.X = csr_matrix(adata.X, dtype=np.float32)
+    else:
+        adata.X = np.asarray(adata.X, dtype=np.float32)
+    return adata, False, prefiltered
+
+
+def read_references(config, paths):
+    """
+    Reads and preprocesses (or loads from the reference cache) the references
+    paths one after the other. Returns them as one MultiReference: cell-types
+    are matched by name, genes are those common to all references, cells
+    without batch are labeled with their reference and X is never concatenated.
+    """
+    references = []
+    for path in paths:
+        key = reference_key(config, path)
+        adata, preprocessed, prefiltered = read_reference(config, key, path)
+        if not preprocessed:
+            adata = preprocess_reference(adata, config["simulation_params"]["filter"], prefiltered=prefiltered)
+            cache_reference(config, key, adata)
+        print(
+            "Reference {}: {} cells of cell-types {}.".format(
+                path, adata.n_obs, ", ".join(np.sort(adata.obs[config["simulation_params"]["celltype_col"]].unique()))
+            )
+        )
+        references.append(adata)
+    reference = MultiReference(
+        references,
+        [config["simulation_params"]["celltype_col"], config["simulation_params"]["batch_col"]],
+        batch_col=config["simulation_params"]["batch_col"],
+    )
+    print("{} genes are common to all references.".format(len(reference.var_names)))
+    return reference
+
+
+def cache_reference(config, key, adata):
+    """
+    Stores the preprocessed reference under key in the reference cache, as CSR
+    with the cell-type and batch columns and the gene and cell index only.
+    """
+    if key is None:
+        return
+    columns = [
+        col
+        for col in [config["simulation_params"]["celltype_col"], config["simulation_params"]["batch_col"]]
+        if col in adata.obs.columns
+    ]
+    reference = AnnData(
+        csr_matrix(adata.X),
+        obs=adata.obs[columns],
+        var=pd.DataFrame(index=adata.var_names),
+    )
+    cache = Cache(
+        config["simulation_params"]["cache_dir"], config["simulation_params"]["cache_size_limit"]
+    )
+    cache.add(key, lambda path: reference.write(os.path.join(path, "reference.h5ad")))
+
+
+def celltype_indices(obs, celltype_col, celltypes, mask=None):
+    """Indices of the reference cells of each cell-type, among the cells in mask if given."""
+    if mask is None:
+        mask = np.ones(obs.shape[0], dtype=bool)
+    return [np.where(mask & (obs[celltype_col] == celltype).values)[0] for celltype in celltypes]
+
+
+def batch_groups(obs, config, celltypes, batches):
+    """Indices of the reference cells of each cell-type per batch, into the whole reference."""
+    return [
+        celltype_indices(
+            obs,
+            config["simulation_params"]["celltype_col"],
+            celltypes,
+            (obs[config["simulation_params"]["batch_col"]] == batch).values,
+        )
+        for batch in batches
+    ]
+
+
+def simulation_obs(props, celltypes, batches=None, offset=0):
+    """
+    obs of the simulated samples, numbered from offset. With batches, the
+    samples are repeated per batch, with index <sample>-<batch> and a batch column.
+    """
+    obs = pd.DataFrame(props, columns=celltypes, index=np.arange(offset, offset + len(props)))
+    if batches is None:
+        return obs
+    obs = pd.concat([obs] * len(batches), ignore_index=True)
+    obs.index = ["{}-{}".format(offset + i, batch) for batch in batches for i in range(len(props))]
+    obs["batch"] = pd.Categorical(np.repeat(batches, len(props)), categories=batches)
+    return obs
+
+
+def setup_simulation_folder(config):
+    """
+    Creates the experiment and simulation folders of a new simulation. With
+    resume or n_append, finds the simulation in experiment_folder instead.
+    Returns the simulation folder and the progress of the simulation (see
+    write_progress), whose last entry of n_samples are the samples of this run.
+    """
+    params = config["simulation_params"]
+    if params["resume"] or params["n_append"]:
+        simulation_folder = os.path.join(config["experiment_folder"], "simulation")
+        progress = read_progress(simulation_folder)
+        if progress is None:
+            sys.exit(f"No simulation to resume or append to in {simulation_folder}.")
+        if progress["seed"] != params["seed"] or progress["chunk_size"] != params["chunk_size"]:
+            sys.exit(f"seed and chunk_size have to be the ones of the simulation in {simulation_folder}.")
+        complete = progress["done"] == progress["n_groups"] * sum(progress["n_samples"])
+        if not complete:
+            if not params["resume"]:
+                sys.exit(f"Simulation in {simulation_folder} is incomplete, set resume to True to finish it first.")
+            print("Resuming simulation in {} from row {}.".format(simulation_folder, progress["done"]))
+        elif params["n_append"]:
+            print("Appending {} samples to simulation in {}.".format(params["n_append"], simulation_folder))
+            progress["n_samples"].append(int(params["n_append"]))
+        else:
+            sys.exit(f"Simulation in {simulation_folder} is already complete.")
+        # Files linked from the simulation library are modified in place
+        for name in os.listdir(simulation_folder):
+            unshare_file(os.path.join(simulation_folder, name))
+        return simulation_folder, progress
+
+    simulation_folder = create_simulation_folder(config)
+    progress = {
+        "seed": params["seed"],
+        "chunk_size": params["chunk_size"],
+        "n_samples": [int(params["n_samples"])],
+        "done": 0,
+    }
+    return simulation_folder, progress
+
+
+def create_simulation_folder(config):
+    """Creates the experiment folder (a new one if it exists) and its simulation folder."""
+    if not os.path.exists(config["experiment_folder"]):
+        os.mkdir(config["experiment_folder"])
+    else:
+        from datetime import datetime
+
+        now = datetime.now()
+        date_time = now.strftime("%m.%d.%Y_%H.%M.%S")
+        name = "experiment_" + date_time
+        print(
+            "Specified experiment_folder {} already exists. Creating a new folder with name {}.".format(
+                config["experiment_folder"], name
+            )
         )
+        config["experiment_folder"] = name
+        os.mkdir(config["experiment_folder"])
 
-    def simulate_per_batch(self, save=True):
-        adata_orig = self.sc_adata.copy()
-        adatas = []
-        for batch in self.batches:
-            self.sc_adata = adata_orig[
-                adata_orig.obs[self.config["simulation_params"]["batch_col"]] == batch
+    simulation_folder = os.path.join(config["experiment_folder"], "simulation")
+    if not os.path.exists(simulation_folder):
+        os.mkdir(simulation_folder)
+    else:
+        sys.exit(f"folder {simulation_folder} already exists.")
+    return simulation_folder
+
+
+# simulation_params which do not change the simulated samples
+LIBRARY_IGNORED = [
+    "scdata",
+    "n_jobs",
+    "resume",
+    "n_append",
+    "online",
+    "cache_dir",
+    "cache_size_limit",
+    "library_dir",
+    "library_size_limit",
+    "generate_component_figures",
+    "n_figure_samples",
+    "simulation_folder",
+]
+
+
+def simulation_key(config):
+    """
+    Key of a simulation in the simulation library, a hash of the content of
+    scdata and of the simulation_params that change the simulated samples.
+    With adaptive, samples also depend on the real samples, so the content,
+    format and type of deconv_params test_dataset are part of the key.
+    None if there is no library or the simulation is resumed, appended to or
+    online.
+    """
+    params = config["simulation_params"]
+    if not params["library_dir"] or params["resume"] or params["n_append"] or params["online"]:
+        return None
+    if isinstance(params["scdata"], (list, tuple)):
+        scdata = [file_hash(path) for path in params["scdata"]]
+    else:
+        scdata = file_hash(params["scdata"])
+    items = [scdata, {key: value for key, value in params.items() if key not in LIBRARY_IGNORED}]
+    if params["adaptive"]:
+        deconv_params = config["deconv_params"]
+        items.append(
+            [
+                file_hash(deconv_params["test_dataset"]),
+                deconv_params["test_dataset_format"],
+                deconv_params["test_dataset_type"],
             ]
-            adatas.append(self.simulate(save=False))
-        adata = adatas[0].concatenate(adatas[1:], batch_categories=self.batches)
+        )
+    return config_hash(*items)
+
+
+def library_simulation(config, key):
+    """
+    Links the simulation of key from the simulation library into a new
+    simulation folder of experiment_folder. Returns the folder, None if the
+    library has no such simulation.
+    """
+    path = Cache(config["simulation_params"]["library_dir"]).entry(key)
+    if path is None:
+        return None
+    print("Using simulation {} from the simulation library.".format(path))
+    simulation_folder = create_simulation_folder(config)
+    link_files(path, simulation_folder)
+    return simulation_folder
+
+
+def add_to_library(config, key, simulation_folder):
+    """Adds the finished simulation in simulation_folder to the simulation library under key."""
+    if key is None:
+        return
+    library = Cache(config["simulation_params"]["library_dir"], config["simulation_params"]["library_size_limit"])
+    library.add(key, lambda path: link_files(simulation_folder, path, exclude=["simulation_config.py"]))
+
+
+def skip_rows(progress, n_groups):
+    """Rows of this run written before it was interrupted."""
+    return progress["done"] - n_groups * sum(progress["n_samples"][:-1])
+
+
+def open_writer(folder, progress, n_groups, obs, var, obsm, uns, config):
+    """
+    H5adWriter of simulated.h5ad for the rows of this run: creates the file
+    for a new simulation, appends the rows of obs and obsm when appending and
+    reopens it when resuming. Returns the writer and the first row of this run.
+    """
+    path = os.path.join(folder, "simulated.h5ad")
+    first = n_groups * sum(progress["n_samples"][:-1])
+    if progress.get("n_groups", n_groups) != n_groups:
+        sys.exit("Number of batches differs from the one of the simulation in {}.".format(folder))
+    if "n_groups" not in progress:
+        mode = "w"
+    else:
+        with h5py.File(path, "r") as f:
+            n_obs = f["obs"][f["obs"].attrs["_index"]].shape[0]
+        mode = "r+" if n_obs == first + obs.shape[0] else "a"
+    writer = H5adWriter(
+        path, obs, var, obsm=obsm, uns=uns, chunk_size=config["simulation_params"]["chunk_size"], mode=mode
+    )
+    progress["n_groups"] = n_groups
+    write_progress(folder, progress)
+    return writer, first
+
+
+def checkpoint(folder, progress, writer, done):
+    """Flushes the rows written so far and records them in progress.json."""
+    writer.flush()
+    progress["done"] = int(done)
+    write_progress(folder, progress)
+
+
+def profile_reference(sim, X, groups, exact_fn, profile_fn, save=True):
+    """
+    Cell-type profiles of groups (see celltype_profiles) to simulate sim with
+    simulation_params mode profiles. When saving a new simulation, writes
+    calibration.txt comparing profile_fn to exact_fn on the first samples of
+    the first group.
+    """
+    profiles, profile_groups = celltype_profiles(X, groups)
+    if save and not sim.offset:
+        cells = sim.cells[: sim.config["simulation_params"]["n_calibration_samples"]]
+        report = calibration(
+            X, groups[0], profiles, profile_groups[0], cells, sim.config["simulation_params"]["seed"], exact_fn, profile_fn
+        )
+        pd.Series(report).to_csv(os.path.join(sim.simulation_folder, "calibration.txt"), sep="\t", header=False)
+        print(
+            "Profiles against sampled cells: median relative error of gene means {:.3f}, median ratio of gene variances {:.3f}. See calibration.txt.".format(
+                report["median_relative_error_gene_means"], report["median_ratio_gene_variances"]
+            )
+        )
+    return profiles, profile_groups
+
+
+def save_plan_reference(folder, X, cells_obs, var):
+    """Writes the preprocessed reference which sampling plans refer to."""
+    if isinstance(X, RowStack):
+        # Several references are written one after the other
+        writer = H5adWriter(os.path.join(folder, "reference.h5ad"), cells_obs, var)
+        for block, start in zip(X.blocks, X.offsets):
+            writer.write("X", start, block)
+        writer.close()
+        return
+    AnnData(X, obs=cells_obs, var=var).write(os.path.join(folder, "reference.h5ad"))
+
+
+def shared_plan_reference(sim):
+    """
+    Path and key of the preprocessed reference of sim in the reference cache,
+    which sampling plans refer to instead of a copy of their own. None if
+    caching is disabled or the simulated reference differs from the cached
+    one (several references or sketched), then reference.h5ad is written.
+    """
+    if sim.reference_key is None or getattr(sim, "sketch_report", None) is not None:
+        return None
+    path = Cache(sim.config["simulation_params"]["cache_dir"]).entry(sim.reference_key)
+    if path is None:
+        return None
+    return os.path.join(path, "reference.h5ad"), sim.reference_key
+
+
+def plan_uns(config, average, shared=None):
+    """
+    uns of a simulation stored with its sampling plan, average for mean
+    (spatial) layers. The plan refers to the shared cached reference if given
+    (see shared_plan_reference), to reference.h5ad of the simulation otherwise.
+    """
+    info = {
+        "reference": "reference.h5ad",
+        "celltype_col": config["simulation_params"]["celltype_col"],
+        "average": average,
+    }
+    if shared is not None:
+        info["reference"], info["reference_key"] = shared
+    return {"sampling_plan": info}
+
+
+def expression_layers(adata, folder):
+    """
+    Per cell-type layers of a simulated AnnData. Stored layers are returned as
+    they are. If only the sampling plan was stored (expr_storage "plan"), the
+    layers are built from obsm["sampling_plan"] and the preprocessed reference,
+    in the reference cache or in folder, the simulation folder.
+    """
+    if "sampling_plan" not in adata.uns:
+        return {layer: adata.layers[layer] for layer in adata.layers}
+
+    info = adata.uns["sampling_plan"]
+    path = os.path.join(folder, info["reference"])
+    if not os.path.exists(path):
+        sys.exit(
+            "Reference {} of the sampling plan does not exist. If it was evicted from the reference cache (key {}), simulate again.".format(
+                path, info.get("reference_key")
+            )
+        )
+    reference = sc.read(path)
+    reference = reference[:, adata.var_names.tolist()]
+    celltypes = [col for col in adata.obs.columns if col not in ["ds", "batch"]]
+    celltype_indices = [
+        np.where(reference.obs[info["celltype_col"]] == celltype)[0] for celltype in celltypes
+    ]
+    layers = plan_layers(
+        adata.obsm["sampling_plan"], reference.X, celltype_indices, average=bool(info["average"])
+    )
+    return dict(zip(celltypes, layers))
 
-        if save:
-            adata.write(os.path.join(self.simulation_folder, "simulated.h5ad"))
-            if self.config["simulation_params"]["generate_component_figures"]:
-                self._generate_component_figures(adata)
-        else:
-            return adata
 
 def save_dict_to_file(config):
     f = open(os.path.join(config["simulation_params"]["simulation_folder"], "simulation_config.py"), "w")
@@ -581,7 +845,21 @@ def save_dict_to_file(config):
 
 def simulate(config):
 
-    s = 42
+    if config["simulation_params"]["mode"] not in ["cells", "profiles"]:
+        sys.exit("mode {} in simulation_params is not supported.".format(config["simulation_params"]["mode"]))
+    if config["simulation_params"]["online"] and (
+        config["simulation_params"]["mode"] != "cells" or config["simulation_params"]["adaptive"]
+    ):
+        sys.exit("online simulations only support mode cells, without adaptive proportions.")
+    key = simulation_key(config)
+    if key is not None:
+        simulation_folder = library_simulation(config, key)
+        if simulation_folder is not None:
+            config["simulation_params"]["simulation_folder"] = simulation_folder
+            config["deconv_params"]["reference"] = os.path.join(simulation_folder, "simulated.h5ad")
+            save_dict_to_file(config)
+            return
+    s = config["simulation_params"]["seed"]
     random.seed(s)
     np.random.seed(s)
     if config["simulation_params"]["type"]=="bulk":
@@ -590,7 +868,25 @@ def simulate(config):
         sim = Simulate_st()
     sim.initialize(config)
     sim.preprocess()
+    sim.sketch()
+    if config["simulation_params"]["online"]:
+        # Samples are simulated while training (see OnlineSimulation), only the reference is stored
+        simulation_folder = create_simulation_folder(config)
+        columns = [
+            col
+            for col in [config["simulation_params"]["celltype_col"], config["simulation_params"]["batch_col"]]
+            if col in sim.sc_adata.obs.columns
+        ]
+        save_plan_reference(
+            simulation_folder, sim.sc_adata.X, sim.sc_adata.obs[columns], pd.DataFrame(index=sim.sc_adata.var_names)
+        )
+        config["simulation_params"]["simulation_folder"] = simulation_folder
+        config["deconv_params"]["reference"] = os.path.join(simulation_folder, "reference.h5ad")
+        save_dict_to_file(config)
+        return
     sim.generate_props()
+    if sim.sketch_report is not None:
+        sim.sketch_report.to_csv(os.path.join(sim.simulation_folder, "sketch.txt"), sep="\t", index=False)
     batch_col = sim.config["simulation_params"]["batch_col"]
     columns = sim.sc_adata.obs.columns
     # print(batch_col)
@@ -609,4 +905,13 @@ def simulate(config):
         sim.config["simulation_params"]["concentration"] = list(sim.config["simulation_params"]["concentration"])
     sim.config["deconv_params"]["reference"] = os.path.join(sim.config["simulation_params"]["simulation_folder"], "simulated.h5ad")
     save_dict_to_file(sim.config)
+    folder = sim.config["simulation_params"]["simulation_folder"]
+    figure_worker = getattr(sim, "figure_worker", None)
+    if figure_worker is not None and key is not None:
+        # The library entry is added with the figures, once they are done
+        figure_worker.on_done = lambda code: add_to_library(sim.config, key, folder)
+    else:
+        add_to_library(sim.config, key, folder)
+    # Reports figure processes that finished so far, the running ones are checked at exit
+    check_component_figures()
     
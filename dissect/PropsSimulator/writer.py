@@ -0,0 +1,176 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import h5py
+from scipy.sparse import csr_matrix, issparse
+from anndata import AnnData
+
+try:
+    from anndata.io import read_elem, write_elem
+except ImportError:
+    from anndata.experimental import read_elem, write_elem
+
+
+class H5adWriter(object):
+    """
+    Writes an .h5ad file in row chunks, so that X and layers are never held in
+    memory as a whole. obs, var and obsm are written when the writer is created,
+    X and layers are appended chunk by chunk, in order of rows. Dense chunks are
+    stored as a chunked HDF5 dataset, sparse ones as a CSR group which grows as
+    chunks are appended. The result is a regular AnnData file.
+
+    mode "w" creates the file, "r+" reopens a file written by a writer to
+    continue writing it, and "a" appends the rows of obs and obsm to it, after
+    which the new rows are written like the others.
+    """
+
+    def __init__(self, path, obs, var, obsm=None, uns=None, chunk_size=1000, mode="w"):
+        obs = obs.copy()
+        obs.index = obs.index.astype(str)
+        if mode == "w":
+            adata = AnnData(obs=obs, var=var, uns=uns)
+            if obsm:
+                for key in obsm:
+                    adata.obsm[key] = obsm[key]
+            adata.write(path)
+            del adata
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.file = h5py.File(path, "a")
+        self.file.require_group("layers")
+        if mode == "a":
+            self._append(obs, obsm)
+        self.shape = (self.file["obs"][self.file["obs"].attrs["_index"]].shape[0], var.shape[0])
+
+    def _append(self, obs, obsm):
+        """Appends the rows of obs and obsm, and grows X, layers and sparse obsm to the new rows."""
+        obs = pd.concat([read_elem(self.file["obs"]), obs])
+        del self.file["obs"]
+        write_elem(self.file, "obs", obs)
+        for key in obsm or {}:
+            value = np.concatenate([self.file["obsm"][key][:], obsm[key]], axis=0)
+            del self.file["obsm"][key]
+            write_elem(self.file["obsm"], key, value)
+        elements = ["X"] + ["layers/" + key for key in self.file["layers"]]
+        elements += ["obsm/" + key for key in self.file["obsm"] if key not in (obsm or {})]
+        for key in elements:
+            if key not in self.file:
+                continue
+            element = self.file[key]
+            if isinstance(element, h5py.Dataset):
+                element.resize(obs.shape[0], axis=0)
+            else:
+                nnz = element["indptr"][-1]
+                element["indptr"].resize((obs.shape[0] + 1,))
+                element["indptr"][-(obs.shape[0] - element.attrs["shape"][0]) :] = nnz
+                element.attrs["shape"] = (obs.shape[0], element.attrs["shape"][1])
+
+    def _create(self, key, X):
+        # Rows of every element are the samples, columns are genes or e.g. reference cells in obsm
+        n_obs, n_vars = self.shape[0], X.shape[1]
+        if issparse(X):
+            group = self.file.create_group(key)
+            group.attrs["encoding-type"] = "csr_matrix"
+            group.attrs["encoding-version"] = "0.1.0"
+            group.attrs["shape"] = (n_obs, n_vars)
+            idx_dtype = np.int32 if n_vars < np.iinfo(np.int32).max else np.int64
+            group.create_dataset("data", shape=(0,), maxshape=(None,), dtype=X.dtype, chunks=True)
+            group.create_dataset("indices", shape=(0,), maxshape=(None,), dtype=idx_dtype, chunks=True)
+            group.create_dataset("indptr", data=np.zeros(n_obs + 1, dtype=np.int64), maxshape=(None,), chunks=True)
+        else:
+            dataset = self.file.create_dataset(
+                key,
+                shape=(n_obs, n_vars),
+                dtype=X.dtype,
+                maxshape=(None, n_vars),
+                chunks=(max(min(self.chunk_size, n_obs), 1), n_vars),
+            )
+            dataset.attrs["encoding-type"] = "array"
+            dataset.attrs["encoding-version"] = "0.2.0"
+
+    def write(self, key, start, X):
+        """Writes the rows start:start + X.shape[0] of element key, e.g. X, layers/<name> or obsm/<name>."""
+        if key not in self.file:
+            self._create(key, X)
+        element = self.file[key]
+        if isinstance(element, h5py.Dataset):
+            element[start : start + X.shape[0]] = X.toarray() if issparse(X) else X
+        else:
+            X = csr_matrix(X)
+            if not X.has_sorted_indices:
+                X.sort_indices()
+            nnz = element["indptr"][start]
+            for name in ["data", "indices"]:
+                element[name].resize((nnz + X.nnz,))
+                element[name][nnz:] = getattr(X, name)
+            element["indptr"][start + 1 : start + 1 + X.shape[0]] = X.indptr[1:] + nnz
+
+    def write_chunk(self, start, X, layers=None):
+        """Writes X and the named layers ({name: matrix}) of one chunk of rows."""
+        self.write("X", start, X)
+        if layers:
+            for name in layers:
+                self.write("layers/" + name, start, layers[name])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_progress(folder):
+    """Progress of the simulation in folder, see write_progress. None if there is none."""
+    path = os.path.join(folder, "progress.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_progress(folder, progress):
+    """
+    Writes progress.json of a simulation: seed, chunk_size, n_groups (batches),
+    n_samples (samples per batch of every part, i.e. the first simulation and
+    every append) and done (rows of simulated.h5ad written so far).
+    """
+    path = os.path.join(folder, "progress.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(progress, f)
+    os.replace(path + ".tmp", path)
+
+
+def read_rows(element, idx, indptr=None):
+    """
+    Rows idx (sorted) of a dense or CSR element of an open .h5ad file, e.g.
+    file["X"]. Runs of consecutive rows are read as slices, so only the
+    selected rows are read from disk. indptr of a CSR element can be passed
+    when reading it in several calls, so it is only read once.
+    """
+    runs = np.split(idx, np.where(np.diff(idx) > 1)[0] + 1) if len(idx) else []
+    if isinstance(element, h5py.Dataset):
+        if not runs:
+            return np.zeros((0,) + element.shape[1:], dtype=element.dtype)
+        return np.concatenate([element[run[0] : run[-1] + 1] for run in runs], axis=0)
+
+    n_vars = element.attrs["shape"][1]
+    if indptr is None:
+        indptr = element["indptr"][:]
+    data, indices, row_nnz = [], [], []
+    for run in runs:
+        lo, hi = indptr[run[0]], indptr[run[-1] + 1]
+        data.append(element["data"][lo:hi])
+        indices.append(element["indices"][lo:hi])
+        row_nnz.append(np.diff(indptr[run[0] : run[-1] + 2]))
+    if not runs:
+        return csr_matrix((0, n_vars), dtype=element["data"].dtype)
+    return csr_matrix(
+        (
+            np.concatenate(data),
+            np.concatenate(indices),
+            np.concatenate([[0], np.cumsum(np.concatenate(row_nnz))]),
+        ),
+        shape=(len(idx), n_vars),
+    )
@@ -2,14 +2,23 @@ config = {
     "experiment_folder": "/home/user/experiment",  # Path to save outputs. Default: "/home/user/experiment"
 
     "simulation_params": { 
-        "scdata": "/home/user/experiment/data.h5ad",  # Path to sc/snRNA-seq data, should be anndata
+        "scdata": "/home/user/experiment/data.h5ad",  # Path to sc/snRNA-seq data, should be anndata. A list of paths simulates from
+        # several references at once, each preprocessed on its own, with cell-types matched by name and the genes common to all.
+        # Cells without batch_col value (or of references without batch_col) form one batch per reference, "reference<i>"
         "save_expr": True,
+        "expr_storage": "layers",  # How to store cell-type specific expression if save_expr. "layers" stores one layer per cell-type,
+        # "plan" only stores which reference cells were sampled per sample, layers are built when needed from the preprocessed reference.
+        # With cache_dir, the plan refers to the cached reference, otherwise a copy is stored with the simulation
+        "dense_output": True,  # Whether to store the simulated samples (X) as a dense matrix. If False, X is kept sparse (CSR)
         "n_samples": None,  # Number of samples to generate. Default (None): 1000 times the number of celltypes,
         "type": "bulk", # bulk or st to simulate bulk and spatial transcriptomics respectively
         "celltype_col": "celltype",  # Name of the column corresponding to cell-type labels in adata.obs
         "batch_col": None,  # If more than one batches are present, name of the column corrsponding to batch labels in adata.obs
         "cells_per_sample": 500,  # Number of cells to sample to generate one sample.
-        "downsample": None,  # If simulation_type is ST, a float is used to downsample counts. Default (None): No downsampling
+        "mode": "cells",  # "cells" sums sampled reference cells. "profiles" draws every sample from mean and variance profiles
+        # of the cell-types (Gamma per cell-type), which is faster for large cells_per_sample and does not store a sampling plan
+        "n_calibration_samples": 500,  # If mode is profiles, number of samples simulated both ways for calibration.txt
+        "downsample": None,  # If simulation_type is ST, a float is used to downsample counts, i.e. the fraction of counts kept (binomial thinning). Default (None): No downsampling
         "preprocess": None, # Default (None) will no preprocess
         "filter": {  # Filtering of sc/snRNA-seq before simulating
             "min_genes": 200,
@@ -17,6 +26,8 @@ config = {
             "mt_cutoff": 5,
             "min_expr": 0,  # in log2(1+count)
         },
+        "max_cells_per_celltype": None,  # Keeps at most this many cells of each cell-type (per batch) of the preprocessed reference,
+        # chosen by geometric sketching of its PCA to keep rare states. Kept cells are reported in sketch.txt. Default (None): All cells
         "concentration": None,  # Concentration parameter for dirichlet distribution
         # Should be a vector of same length as the number of cell-types with non-zero values
         # Higher concentrations will be favored. e.g. concentration [0.2,0.2,1] for 3 cell-types will make fractions
@@ -25,7 +36,22 @@ config = {
         "prop_sparse": 0.5,  # Proportion of sparse samples to generate. Default: 0.5
         # Sparse samples are samples in which some cell-types do not exist.
         # Probabilities of cell-types to not be present in the generate sample are uniform.
+        "adaptive": 0,  # Fraction of samples whose proportions are drawn around the fractions of the real samples (deconv_params test_dataset),
+        # estimated by NNLS against the mean profiles of the cell-types. Concentrates samples where real samples lie. Default (0): None
+        "adaptive_precision": 50,  # Concentration of the Dirichlet around each estimated fraction, higher stays closer to the estimates
         "generate_component_figures": True,  # Computes PCA of celltype signatures per generated sample
+        "n_figure_samples": 10000,  # Number of generated samples (randomly chosen) used for the component figures
+        "seed": 42,  # Random seed of the simulation. Results are identical for a given seed and chunk_size, irrespective of n_jobs
+        "n_jobs": 1,  # Number of worker processes to simulate with, also for the training batches if online. -1 uses all cores
+        "chunk_size": 1000,  # Number of samples simulated per shard, each shard has its own random stream
+        "online": False,  # If True, no samples are stored. Training samples are simulated on the fly from the preprocessed reference (mode cells only, without adaptive)
+        "resume": False,  # Resume the interrupted simulation in experiment_folder from its last finished chunk
+        "n_append": None,  # Number of samples to append to the finished simulation in experiment_folder. Default (None): New simulation
+        "cache_dir": None,  # Folder to cache preprocessed references in, keyed by scdata, celltype_col, batch_col and filter. Default (None): No caching
+        "cache_size_limit": 50,  # Size limit of cache_dir in GB. Least recently used references are evicted
+        "library_dir": None,  # Folder of finished simulations shared across experiments, keyed by scdata and simulation_params.
+        # A matching simulation is linked into experiment_folder instead of simulated again. Default (None): No library
+        "library_size_limit": 200,  # Size limit of library_dir in GB. Least recently used simulations are evicted
     },
 
     "deconv_params": {
@@ -42,6 +68,10 @@ config = {
         "mix": "srm", # srm (simulation-real mixture) mixes simulation and real data, and is intended for bulk and spatial RNAseq data. 
                       # rrm (real-real mixture) mixes real data with itself, and is intended for bulk proteome data where same preprocessing can not be established as in RNAseq. 
         "save_config": True,
+        "dataset_dtype": "float32",  # dtype of the expression arrays of the prepared dataset, float32 or float16 to halve their size.
+        # A sparse h5ad test_dataset is kept sparse (CSR) and float32
+        "dataset_cache_dir": None,  # Folder of the prepared simulated and test datasets, keyed by their inputs and the settings above.
+        # A new test_dataset only prepares its own side. Default (None): experiment_folder/dataset_cache
         "network_params": {
             "n_hidden_layers": 4,  # Number of hidden layers
             "hidden_units": [
@@ -29,16 +29,27 @@ from keras import backend as K
 from keras.datasets import mnist
 from tensorflow.keras.utils import to_categorical
 import scipy
+from dissect.PropsSimulator.simulator import expression_layers
+from dissect.utils.ingest import read_table_cached
 
 warnings.filterwarnings("ignore")
 
 
 def run_dissect_expr(config):
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    if config["simulation_params"]["online"]:
+        print("Estimation of cell-type expression needs stored simulations, simulation_params online has to be False.")
+        return
     test_format = config["deconv_params"]["test_dataset_format"]
     real_path = config["deconv_params"]["test_dataset"]
 
     data = sc.read(config["deconv_params"]["reference"])
+    if "sampling_plan" in data.uns:
+        # Cell-type layers are built from the stored sampling plan
+        layers = expression_layers(data, os.path.dirname(config["deconv_params"]["reference"]))
+        for layer in layers:
+            data.layers[layer] = layers[layer]
+        del data.obsm["sampling_plan"]
     data.var_names_make_unique()
 
     data.obs = data.obs[[col for col in data.obs.columns if col not in ["ds", "batch"]]]
@@ -47,7 +58,7 @@ def run_dissect_expr(config):
     if test_format == "h5ad":
         real_data = sc.read(real_path)
     else:
-        real_data = AnnData(pd.read_table(real_path, index_col=0).T)
+        real_data = AnnData(read_table_cached(real_path).T)
 
     ens_path = os.path.join(config["experiment_folder"], "dissect_fractions_ens.txt")
     zero_path = os.path.join(config["experiment_folder"], "dissect_fractions_0.txt")
@@ -88,10 +99,10 @@ def run_dissect_expr(config):
     real_data = real_data[:, common_genes]
     data = data[:, common_genes]
 
-    X_real = np.array(real_data.X)
+    X_real = real_data.X.toarray() if scipy.sparse.issparse(real_data.X) else np.array(real_data.X)
 
     X_celltypes = {}
-    X_sim = np.array(data.X)
+    X_sim = data.X.toarray() if scipy.sparse.issparse(data.X) else np.array(data.X)
     for layer in data.layers:
         if scipy.sparse.issparse(data.layers[layer]):
             data.layers[layer] = data.layers[layer].toarray()
@@ -383,7 +394,7 @@ def run_dissect_expr(config):
     if test_format == "h5ad":
         real_data = sc.read(real_path)
     elif test_format == "txt":
-        X_real = pd.read_table(real_path, index_col=0).T
+        X_real = read_table_cached(real_path).T
         real_data = AnnData(X_real)
 
     real_data.var_names_make_unique()
@@ -3,14 +3,117 @@ import sys
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+from scipy.sparse import issparse
 from dissect.utils.network_fn import network1 as network
 from dissect.utils.network_fn import loss
 from tqdm import tqdm
 import random
 from dissect.utils.utils_fn import normalize_per_batch, reproducibility, ccc_fn
+from dissect.PropsSimulator.online import OnlineSimulation
+from dissect.utils.dataset import load_dataset
 from sklearn.metrics import mean_squared_error
 import logging
 
+def online_dataset(simulation, model, batch_size, n_features, n_celltypes):
+    """
+    Batches (X_sim, y_sim) simulated by simulation while training model, step
+    by step. With simulation_params n_jobs > 1, batches are simulated ahead of
+    the training step in worker processes, see OnlineSimulation.batches.
+    """
+    config = simulation.config
+    return tf.data.Dataset.from_generator(
+        lambda: simulation.batches(
+            model,
+            batch_size,
+            config["deconv_params"]["network_params"]["n_steps"],
+            config["simulation_params"]["n_jobs"],
+            os.path.join(config["experiment_folder"], "simulation", "online_shared"),
+        ),
+        output_signature=(
+            tf.TensorSpec(shape=(batch_size, n_features), dtype=tf.float32),
+            tf.TensorSpec(shape=(batch_size, n_celltypes), dtype=tf.float32),
+        ),
+    ).prefetch(tf.data.AUTOTUNE)
+
+
+def stored_dataset(X_sim, y_sim, batch_size):
+    """
+    Batches (X_sim, y_sim) of stored simulated samples, shuffled as
+    from_tensor_slices(...).shuffle(1000) would. Only the indices are
+    shuffled, the rows of each batch are read from X_sim and y_sim (which may
+    be memory-mapped) when the batch is needed, and cast to float32.
+    """
+
+    def read_batch(idx):
+        idx = np.sort(idx)
+        return X_sim[idx].astype(np.float32), y_sim[idx].astype(np.float32)
+
+    def batch(idx):
+        X, y = tf.numpy_function(read_batch, [idx], [tf.float32, tf.float32])
+        X.set_shape([batch_size, X_sim.shape[1]])
+        y.set_shape([batch_size, y_sim.shape[1]])
+        return X, y
+
+    return (
+        tf.data.Dataset.range(X_sim.shape[0])
+        .shuffle(1000)
+        .repeat()
+        .batch(batch_size=batch_size)
+        .map(batch, num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+
+def real_dataset(X_real, batch_size):
+    """
+    Batches of real samples for mixing, batch_size random (with replacement)
+    samples of the distinct real samples X_real per batch. Sparse X_real is
+    kept sparse, only the rows of each batch are densified.
+    """
+    n_real = X_real.shape[0]
+    if issparse(X_real):
+
+        def read_batch(idx):
+            return X_real[idx].toarray().astype(np.float32)
+
+        def batch(_):
+            X = tf.numpy_function(
+                read_batch,
+                [tf.random.uniform([batch_size], maxval=n_real, dtype=tf.int32)],
+                tf.float32,
+            )
+            X.set_shape([batch_size, X_real.shape[1]])
+            return X
+
+        return tf.data.Dataset.from_tensors(0).repeat().map(batch)
+
+    X_real = tf.constant(X_real)
+    return (
+        tf.data.Dataset.from_tensors(0)
+        .repeat()
+        .map(
+            lambda _: tf.gather(
+                X_real, tf.random.uniform([batch_size], maxval=n_real, dtype=tf.int32)
+            )
+        )
+    )
+
+
+def predict_real(model, X_real, n_features, batch_size=1024):
+    """
+    Predictions of model for the normalized real samples X_real. Sparse
+    X_real is densified and normalized batch_size samples at a time.
+    """
+    if not issparse(X_real):
+        return model.predict(normalize_per_batch(X_real, n_features))
+    return np.concatenate(
+        [
+            model.predict(normalize_per_batch(X_real[i : i + batch_size].toarray(), n_features))
+            for i in range(0, X_real.shape[0], batch_size)
+        ]
+    )
+
+
 def run_dissect_frac(config):
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
     logging.getLogger('tensorflow').setLevel(logging.FATAL)
@@ -23,24 +126,23 @@ def run_dissect_frac(config):
         )
 
     print("Loading prepared datasets...")
-    X_real_np = np.load(os.path.join(dataset_path, "X_real_train.npy"))
-    X_sim_np = np.load(os.path.join(dataset_path, "X_sim.npy"))
-    y_sim_np = np.load(os.path.join(dataset_path, "y_sim.npy"))
-    X_real_test = np.load(os.path.join(dataset_path, "X_real_test.npy"))
-    sample_names = pd.read_table(
-        os.path.join(dataset_path, "sample_names.txt"), index_col=0
-    ).index.tolist()
-    celltypes = pd.read_table(
-        os.path.join(dataset_path, "celltypes.txt"), index_col=0
-    ).index.tolist()
-
-    X_real_np, X_sim_np, y_sim_np = (
-        np.array(X_real_np, dtype=np.float32),
-        np.array(X_sim_np, dtype=np.float32),
-        np.array(y_sim_np, dtype=np.float32),
-    )
-    X_real_test = np.array(X_real_test, dtype=np.float32)
-    n_features = X_sim_np.shape[1]
+    # Simulated samples stay memory-mapped, batches (of the common genes) are read from disk
+    arrays, index = load_dataset(dataset_path)
+    # Sparse (e.g. spatial) real samples stay sparse, see real_dataset and predict_real
+    X_real_np, X_real_test = arrays["X_real_train"][:], arrays["X_real_test"][:]
+    if not issparse(X_real_test):
+        X_real_np = np.asarray(X_real_np, dtype=np.float32)
+        X_real_test = np.asarray(X_real_test, dtype=np.float32)
+    sample_names = index["sample_names"]
+    celltypes = index["celltypes"]
+    online = config["simulation_params"]["online"]
+    if online:
+        # Training samples are simulated per batch from the reference
+        simulation = OnlineSimulation(config, index["genes"])
+        n_features = len(index["genes"])
+    else:
+        X_sim_np, y_sim_np = arrays["X_sim"], arrays["y_sim"]
+        n_features = X_sim_np.shape[1]
     n_celltypes = len(celltypes)
 
     j = 0
@@ -52,12 +154,15 @@ def run_dissect_frac(config):
         # Create dataset iterators
         np.random.seed(seed)
         tf.random.set_seed(seed)
-        dataset = tf.data.Dataset.from_tensor_slices((X_sim_np, y_sim_np, X_real_np))
-        dataset = (
-            dataset.shuffle(1000)
-            .repeat()
-            .batch(batch_size=config["deconv_params"]["network_params"]["batch_size"])
-        )
+        batch_size = config["deconv_params"]["network_params"]["batch_size"]
+        if online:
+            sim_dataset = online_dataset(simulation, seed, batch_size, n_features, n_celltypes)
+        else:
+            sim_dataset = stored_dataset(X_sim_np, y_sim_np, batch_size)
+        # Real samples are stored once, every batch draws its own
+        dataset = tf.data.Dataset.zip(
+            (sim_dataset, real_dataset(X_real_np, batch_size))
+        ).map(lambda sim, X_real: (sim[0], sim[1], X_real))
         dataset_iter = iter(dataset)
 
         if config["deconv_params"]["network_params"]["hidden_activation"] == "relu6":
@@ -219,7 +324,7 @@ def run_dissect_frac(config):
         model_p = tf.keras.models.load_model(model_path)
 
         # print("Running deconvolution")
-        y_hat = model_p.predict(normalize_per_batch(X_real_test, n_features))
+        y_hat = predict_real(model_p, X_real_test, n_features)
         df_y_hat = pd.DataFrame(y_hat, columns=celltypes)
         df_y_hat.index = sample_names
         results_path = os.path.join(
@@ -236,7 +341,7 @@ def run_dissect_frac(config):
         new_last_layer.build(input_shape=last_layer.input_shape)
         new_last_layer.set_weights([weights, biases])
         pre_softmax_model = tf.keras.models.Model(inputs=model.input, outputs=new_last_layer(model.layers[-2].output))
-        scores = pre_softmax_model.predict(normalize_per_batch(X_real_test, n_features))
+        scores = predict_real(pre_softmax_model, X_real_test, n_features)
 
         df_y_hat_scores = pd.DataFrame(scores, columns=celltypes)
         df_y_hat_scores.index = sample_names
@@ -4,12 +4,24 @@ import numpy as np
 import pandas as pd
 from anndata import AnnData
 import scanpy as sc
+from scipy.sparse import csr_matrix, diags, issparse
 import shutil
 import json
+from dissect.utils.cache import Cache, config_hash, file_stamp
+from dissect.utils.dataset import dataset_sources, load_dataset, save_dataset, save_dataset_view
+from dissect.utils.ingest import read_table_cached
+
+TEST_PARAMS = ["test_dataset_format", "test_dataset_type", "duplicated", "var_cutoff", "normalize_test", "dataset_dtype"]
+SIMULATED_PARAMS = ["simulated", "duplicated", "normalize_simulated", "dataset_dtype"]
+
 
 def dataset(config):
     """
     Prepares datasets for training dissect. Uses parameters from config.py.
+    The simulated and the test side are prepared on their own and kept in
+    dataset_cache_dir, keyed by their inputs and settings. datasets only
+    refers to them, with the common genes as column indices, so a new test
+    dataset only prepares its own side.
     """
     savedir = config["experiment_folder"]
     dataset_path = os.path.join(savedir, "datasets")
@@ -19,11 +31,21 @@ def dataset(config):
         sys.exit("Directory doesn't exist. Please run simulation before.")
     elif os.path.exists(savedir) and not os.path.exists(simulation_path):
         sys.exit("Simulations do not exist. Please run simulation before.")
-    elif os.path.exists(savedir) and os.path.exists(simulation_path):
-        if os.path.exists(dataset_path):
-            sys.exit("Datasets are already prepared for the given configuration.")
-        else:
-            os.mkdir(dataset_path)
+
+    online = config["simulation_params"]["online"]
+    cache = Cache(config["deconv_params"]["dataset_cache_dir"] or os.path.join(savedir, "dataset_cache"))
+    sources = {
+        "test": test_key(config),
+        "simulated": None if online else simulated_key(config),
+        "test_in_mix": config["deconv_params"]["test_in_mix"],
+    }
+    if dataset_sources(dataset_path) == sources:
+        print("Datasets are already prepared for the given configuration.")
+        return
+    if os.path.exists(dataset_path):
+        print("Preparing datasets again for the changed test dataset or settings.")
+        shutil.rmtree(dataset_path)
+    os.mkdir(dataset_path)
 
     if config["deconv_params"]["save_config"]:
         with open(
@@ -35,95 +57,132 @@ def dataset(config):
     ###################
     # Read test dataset
     ###################
-    if config["deconv_params"]["test_dataset_format"] == "txt":
-        X_real = pd.read_table(config["deconv_params"]["test_dataset"], index_col=0)
-    elif config["deconv_params"]["test_dataset_format"] == "h5ad":
-        X_real = sc.read(config["deconv_params"]["test_dataset"])
-        if "parse" in str(type(X_real.X)):
-            X_real.X = np.array(X_real.X.todense())
-        X_real = pd.DataFrame(
-            X_real.X, index=X_real.obs.index.tolist(), columns=X_real.var_names.tolist()
-        ).T
+    # samples x genes, kept sparse (CSR) if the h5ad test dataset is sparse
+    test_path = cache.entry(sources["test"])
+    if test_path is None:
+        test_path = cache.add(sources["test"], lambda path: save_test_side(config, path))
+    else:
+        print("Using the prepared test dataset {}.".format(test_path))
+    _, test_index = load_dataset(test_path)
+    genes_real, sample_names = test_index["genes"], test_index["sample_names"]
 
-    if config["deconv_params"]["test_dataset_type"] == "microarray":
-        X_real = 2**X_real - 1
-        X_real[X_real < 0] = 0
+    ################
+    # Read Reference
+    ################
+    if online:
+        # Samples are simulated while training, only genes and cell-types of the reference are needed
+        X_sc = sc.read(config["deconv_params"]["reference"], backed="r")
+        genes_sim = X_sc.var_names.tolist()
+        celltypes = np.sort(X_sc.obs[config["simulation_params"]["celltype_col"]].unique()).tolist()
+        print("reference has {} distinct genes.".format(len(set(genes_sim))))
+        X_sc.file.close()
+    else:
+        sim_path = cache.entry(sources["simulated"])
+        if sim_path is None:
+            sim_path = cache.add(sources["simulated"], lambda path: save_simulated_side(config, path))
+        else:
+            print("Using the prepared simulated dataset {}.".format(sim_path))
+        _, sim_index = load_dataset(sim_path)
+        genes_sim, celltypes = sim_index["genes"], sim_index["celltypes"]
 
-    # Filter genes
-    if config["deconv_params"]["var_cutoff"]:
-        print(
-            "Removing genes which have less than {} variance in their expressions.".format(
-                config["deconv_params"]["var_cutoff"]
-            )
+    # Prepare datasets, the common genes are column indices into both sides
+    real_index = {gene: i for i, gene in enumerate(genes_real)}
+    sim_columns = [i for i, gene in enumerate(genes_sim) if gene in real_index]
+    genes_intersect = [genes_sim[i] for i in sim_columns]
+    print(
+        "There are {} common genes between simulated and test dataset.".format(
+            len(genes_intersect)
         )
-        genes_to_keep = X_real.var(axis=1) > config["deconv_params"]["var_cutoff"]
-        X_real = X_real.loc[genes_to_keep]
+    )
+    real_columns = [real_index[gene] for gene in genes_intersect]
+    if real_columns == list(range(len(genes_real))):
+        real_columns = None
+    if len(sim_columns) == len(genes_sim):
+        sim_columns = None
 
-    X_real = X_real.T  # s,g
-    genes_real = X_real.columns.tolist()
-    sample_names = X_real.index.tolist()
+    views = {
+        "X_real_train": (test_path, "X_real", real_columns, config["deconv_params"]["test_in_mix"] or None),
+        "X_real_test": (test_path, "X_real", real_columns, None),
+    }
+    if not online:
+        views["X_sim"] = (sim_path, "X_sim", sim_columns, None)
+        views["y_sim"] = (sim_path, "y_sim", None, None)
+    save_dataset_view(
+        dataset_path,
+        views,
+        {"celltypes": celltypes, "sample_names": sample_names, "genes": genes_intersect},
+        sources,
+    )
 
-    n_genes = len(genes_real)
-    n_distinct_genes = len(set(genes_real))
+    print("Done.")
 
-    if n_genes != n_distinct_genes:
-        if config["deconv_params"]["duplicated"] == "first":
-            X_real = X_real.loc[:, ~X_real.columns.duplicated(keep="first")]
-            s = "Kept the gene expressions of the first occured gene"
-            print(
-                "There are duplicated genes in the test dataset. {} as specified in the parameter duplicates in main_config.py".format(
-                    s
-                )
-            )
-        elif config["deconv_params"]["duplicated"] == "sum":
-            X_real = X_real.groupby(X_real.columns, axis=1).sum()
-            s = "Summed the genes expressions of duplicated gene names"
-            print(
-                "There are duplicated genes in the test dataset. {} as specified in the parameter duplicates in main_config.py".format(
-                    s
-                )
-            )
-        elif config["deconv_params"]["duplicated"] == "sum":
-            X_real = X_real.groupby(X_real.columns, axis=1).mean()
-            s = "Took arithmetic mean of the genes expressions of duplicated gene names"
-            print(
-                "There are duplicated genes in the test dataset. {} as specified in the parameter duplicates in main_config.py".format(
-                    s
-                )
-            )
-        else:
-            sys.exit(
-                "duplicated setting {} not supported. Please check config.py file.".format(
-                    config["deconv_params"]["duplicated"]
-                )
-            )
 
-    print("test dataset has {} distinct and variable genes.".format(n_distinct_genes))
+def test_key(config):
+    """
+    Key of the prepared test dataset in dataset_cache_dir, a hash of the
+    path, size and mtime of test_dataset (see file_stamp, its content is not
+    read) and of the deconv_params preparing it.
+    """
+    params = config["deconv_params"]
+    return "test-" + config_hash(
+        file_stamp(params["test_dataset"]), {key: params[key] for key in TEST_PARAMS}
+    )
 
-    # Normalization
-    if config["deconv_params"]["normalize_test"] == "cpm":
-        X_real_anndata = AnnData(
-            np.array(X_real), dtype=np.float32, var=pd.DataFrame(index=X_real.columns.tolist())
-        )
-        sc.pp.normalize_total(X_real_anndata, target_sum=1e6)
-        X_real = pd.DataFrame(
-            X_real_anndata.X,
-            index=X_real.index.tolist(),
-            columns=X_real.columns.tolist(),
-        )
-        del X_real_anndata
-    elif not config["deconv_params"]["normalize_test"]:
-        pass
-    else:
-        sys.exit(
-            "{} in normalize_test in config is not supported.".format(
-                config["deconv_params"]["normalize_simulated"]
-            )
-        )
 
-    ################
-    # Read Reference
-    ################
+def simulated_key(config):
+    """
+    Key of the prepared simulated dataset in dataset_cache_dir, a hash of the
+    path, size and mtime of the simulated samples (see file_stamp) and of the
+    deconv_params preparing them.
+    """
+    params = config["deconv_params"]
+    return "simulated-" + config_hash(
+        file_stamp(params["reference"]), {key: params[key] for key in SIMULATED_PARAMS}
+    )
+
+
+def save_test_side(config, path):
+    """Prepares the test dataset (see test_dataset) and saves it to the folder path."""
+    X_real, genes_real, sample_names = test_dataset(config)
+    print("Saving numpy files.")
+    save_dataset(
+        path,
+        {"X_real": dataset_array(X_real, config["deconv_params"]["dataset_dtype"])},
+        {"genes": genes_real, "sample_names": sample_names},
+    )
+
+
+def save_simulated_side(config, path):
+    """Prepares the simulated samples (see simulated_dataset) and saves them to the folder path."""
+    X_sim, y_sim, genes_sim = simulated_dataset(config)
+    print("Saving numpy files.")
+    save_dataset(
+        path,
+        {
+            "X_sim": dataset_array(X_sim.to_numpy(), config["deconv_params"]["dataset_dtype"]),
+            "y_sim": y_sim.to_numpy(dtype=np.float32),
+        },
+        {"genes": genes_sim, "celltypes": y_sim.columns.tolist()},
+    )
+
+
+def dataset_array(X, dtype):
+    """
+    X as stored in a prepared dataset: in dtype, or float32 if X is sparse
+    (scipy has no float16 sparse matrices) or exceeds the range of dtype.
+    """
+    Y = X.astype(np.float32 if issparse(X) else dtype)
+    if np.isinf(Y.data if issparse(Y) else Y).any():
+        print("Expression exceeds the range of {}, saving it as float32.".format(dtype))
+        Y = X.astype(np.float32)
+    return Y
+
+
+def simulated_dataset(config):
+    """
+    Reads and normalizes the simulated samples. Returns their expression,
+    proportions and genes.
+    """
     X_sc = sc.read(config["deconv_params"]["reference"])
 
     # Simulated if not simulated
@@ -154,95 +213,138 @@ def dataset(config):
         X_sim.X, columns=X_sim.var_names.tolist(), index=X_sim.obs.index.tolist()
     )
 
-    genes_sim = X_sim.columns.tolist()
-    n_genes = len(genes_sim)
-    n_distinct_genes = len(set(genes_sim))
-
-    if n_genes != n_distinct_genes:
-        if config["deconv_params"]["duplicated"] == "first":
-            X_sim = X_sim.loc[:, ~X_sim.columns.duplicated(keep="first")]
-            s = "Kept the gene expressions of the first occured gene"
-            print(
-                "There are duplicated genes in the simulated dataset. {} as specified in the parameter duplicates in main_config.py".format(
-                    s
-                )
-            )
-        elif config["deconv_params"]["duplicated"] == "sum":
-            X_sim = X_sim.groupby(X_sim.columns, axis=1).sum()
-            s = "Summed the genes expressions of duplicated gene names"
-            print(
-                "There are duplicated genes in the simulated dataset. {} as specified in the parameter duplicates in main_config.py".format(
-                    s
-                )
-            )
-        elif config["deconv_params"]["duplicated"] == "sum":
-            X_sim = X_sim.groupby(X_sim.columns, axis=1).mean()
-            s = "Took arithmetic mean of the genes expressions of duplicated gene names"
-            print(
-                "There are duplicated genes in the simulated dataset. {} as specified in the parameter duplicates in main_config.py".format(
-                    s
-                )
-            )
-        else:
-            sys.exit(
-                "duplicated setting {} not supported. Please check config.py file.".format(
-                    config["deconv_params"]["duplicated"]
-                )
-            )
+    n_distinct_genes = len(set(X_sim.columns))
+    X, genes = aggregate_duplicates(
+        X_sim.to_numpy(), X_sim.columns.tolist(), config["deconv_params"]["duplicated"], "simulated"
+    )
+    X_sim = pd.DataFrame(X, index=X_sim.index, columns=genes)
     print("simulated dataset has {} distinct genes.".format(n_distinct_genes))
+    return X_sim, y_sim, X_sim.columns.tolist()
 
-    # Prepare datasets
-    genes_intersect = list(set(genes_real) & set(genes_sim))
-    print(
-        "There are {} common genes between simulated and test dataset.".format(
-            len(genes_intersect)
-        )
-    )
-    X_sim, X_real = X_sim.loc[:, genes_intersect], X_real.loc[:, genes_intersect]
 
-    X_real_test = X_real.copy()
-    if config["deconv_params"]["test_in_mix"]:
-        X_real = X_real.iloc[0 : config["deconv_params"]["test_in_mix"], :]
+def test_dataset(config):
+    """
+    Reads, filters, deduplicates and normalizes the test dataset. Returns its
+    expression (samples x genes), genes and sample names. A sparse h5ad test
+    dataset (e.g. spatial spots) stays CSR throughout.
+    """
+    if config["deconv_params"]["test_dataset_format"] == "txt":
+        df = read_table_cached(config["deconv_params"]["test_dataset"])
+        X_real = np.ascontiguousarray(df.to_numpy().T)
+        genes_real, sample_names = df.index.tolist(), df.columns.tolist()
+        del df
+    elif config["deconv_params"]["test_dataset_format"] == "h5ad":
+        adata = sc.read(config["deconv_params"]["test_dataset"])
+        X_real = csr_matrix(adata.X) if issparse(adata.X) else np.asarray(adata.X)
+        genes_real, sample_names = adata.var_names.tolist(), adata.obs_names.tolist()
+        del adata
+
+    if config["deconv_params"]["test_dataset_type"] == "microarray":
+        # 2**0 - 1 = 0, sparse entries stay zero
+        if issparse(X_real):
+            X_real = X_real.astype(np.float32)
+            X_real.data = np.maximum(2**X_real.data - 1, 0)
+        else:
+            X_real = np.maximum(2**X_real - 1, 0)
 
-    real_size = X_real.shape[0]
-    sim_size = X_sim.shape[0]
+    # Filter genes
+    if config["deconv_params"]["var_cutoff"]:
+        print(
+            "Removing genes which have less than {} variance in their expressions.".format(
+                config["deconv_params"]["var_cutoff"]
+            )
+        )
+        genes_to_keep = np.flatnonzero(gene_variance(X_real) > config["deconv_params"]["var_cutoff"])
+        X_real = X_real[:, genes_to_keep]
+        genes_real = [genes_real[i] for i in genes_to_keep]
 
-    if X_real.shape[0] < X_sim.shape[0]:
-        X_real = pd.concat([X_real] * int(sim_size / real_size), ignore_index=True)
-    real_size = X_real.shape[0]
-    curr_size = real_size
+    n_distinct_genes = len(set(genes_real))
+    X_real, genes_real = aggregate_duplicates(
+        X_real, genes_real, config["deconv_params"]["duplicated"], "test"
+    )
+    print("test dataset has {} distinct and variable genes.".format(n_distinct_genes))
 
-    while curr_size < sim_size:
-        X_real = X_real.append(X_real.iloc[curr_size - real_size, :], ignore_index=True)
-        curr_size += 1
+    # Normalization
+    if config["deconv_params"]["normalize_test"] == "cpm":
+        X_real = normalize_cpm(X_real)
+    elif not config["deconv_params"]["normalize_test"]:
+        pass
+    else:
+        sys.exit(
+            "{} in normalize_test in config is not supported.".format(
+                config["deconv_params"]["normalize_simulated"]
+            )
+        )
+    return X_real, genes_real, sample_names
 
-    if X_sim.shape[0] < X_real.shape[0]:
-        X_sim = pd.concat([X_sim] * int(real_size / sim_size), ignore_index=True)
-    sim_size = X_sim.shape[0]
-    curr_size = sim_size
 
-    while curr_size < real_size:
-        X_sim = X_sim.append(X_sim.iloc[curr_size - sim_size, :], ignore_index=True)
-        curr_size += 1
+def gene_variance(X):
+    """Sample variance (ddof=1) of every gene (column) of X, dense or sparse."""
+    if not issparse(X):
+        return X.var(axis=0, ddof=1)
+    n = X.shape[0]
+    mean = np.asarray(X.mean(axis=0, dtype=np.float64)).ravel()
+    sq_sum = np.asarray(X.multiply(X).sum(axis=0, dtype=np.float64)).ravel()
+    return (sq_sum - n * mean**2) / (n - 1)
 
-    final_dataset = [X_real, X_sim, y_sim, X_real_test, sample_names]
 
-    print("Saving numpy files.")
+def aggregate_duplicates(X, genes, duplicated, name):
+    """
+    Combines the columns of duplicated genes of X (samples x genes, dense or
+    CSR) as set by duplicated: the first one, their sum or their mean. Sums
+    and means are a product with a sparse aggregation matrix (genes x
+    distinct genes), distinct genes are sorted as by groupby. Returns X and
+    its genes.
+    """
+    genes = np.asarray(genes)
+    distinct, first, inverse, counts = np.unique(
+        genes, return_index=True, return_inverse=True, return_counts=True
+    )
+    if len(distinct) == len(genes):
+        return X, genes.tolist()
 
-    np.save(os.path.join(dataset_path, "X_real_train.npy"), X_real, allow_pickle=True)
-    np.save(os.path.join(dataset_path, "X_sim.npy"), X_sim, allow_pickle=True)
-    np.save(os.path.join(dataset_path, "y_sim.npy"), y_sim, allow_pickle=True)
-    np.save(
-        os.path.join(dataset_path, "X_real_test.npy"), X_real_test, allow_pickle=True
+    if duplicated == "first":
+        keep = np.sort(first)
+        X, genes = X[:, keep], genes[keep]
+        s = "Kept the gene expressions of the first occured gene"
+    elif duplicated in ["sum", "mean"]:
+        weights = np.ones(len(genes)) if duplicated == "sum" else 1 / counts[inverse]
+        dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+        A = csr_matrix(
+            (weights.astype(dtype), (np.arange(len(genes)), inverse)),
+            shape=(len(genes), len(distinct)),
+        )
+        X, genes = X @ A, distinct
+        if duplicated == "sum":
+            s = "Summed the genes expressions of duplicated gene names"
+        else:
+            s = "Took arithmetic mean of the genes expressions of duplicated gene names"
+    else:
+        sys.exit(
+            "duplicated setting {} not supported. Please check config.py file.".format(
+                duplicated
+            )
+        )
+    print(
+        "There are duplicated genes in the {} dataset. {} as specified in the parameter duplicates in main_config.py".format(
+            name, s
+        )
     )
-    celltypes = pd.DataFrame(index=y_sim.columns.tolist())
-    celltypes.to_csv(os.path.join(dataset_path, "celltypes.txt"), sep="\t")
-    sample_names = pd.DataFrame(index=sample_names)
-    sample_names.to_csv(os.path.join(dataset_path, "sample_names.txt"), sep="\t")
-    genes = pd.DataFrame(index=genes_intersect)
-    genes.to_csv(os.path.join(dataset_path, "genes.txt"), sep="\t")
+    return X, genes.tolist()
 
-    print("Done.")
+
+def normalize_cpm(X):
+    """
+    X (samples x genes, dense or CSR) as float32 with every sample scaled to
+    sum to 1e6, as sc.pp.normalize_total(target_sum=1e6).
+    """
+    X = X.astype(np.float32)
+    counts = np.asarray(X.sum(axis=1)).ravel()
+    counts[counts == 0] = 1
+    scale = (1e6 / counts).astype(np.float32)
+    if issparse(X):
+        return csr_matrix(diags(scale) @ X)
+    return X * scale[:, None]
 
 
 if __name__ == "__main__":
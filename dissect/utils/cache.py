@@ -0,0 +1,140 @@
+import os
+import json
+import shutil
+import hashlib
+
+
+_file_hashes = {}
+
+
+def file_hash(path, block_size=2**24):
+    """sha1 of the content of a file, computed once per process for a given size and mtime."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        _file_hashes[key] = _hash_content(path, block_size)
+    return _file_hashes[key]
+
+
+def file_stamp(path):
+    """
+    Absolute path, size and mtime of a file, a key which does not read its
+    content. Changes when the file is rewritten.
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _hash_content(path, block_size):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def config_hash(*items):
+    """sha1 of json-serializable items such as file hashes and config blocks."""
+    return hashlib.sha1(
+        json.dumps(items, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def folder_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if not os.path.islink(os.path.join(root, name)):
+                size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def link_files(src, dst, exclude=()):
+    """
+    Hard-links the files of folder src into folder dst, copies them if src and
+    dst are on different file systems. Files stay valid when src is removed.
+    """
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        if name in exclude or not os.path.isfile(path):
+            continue
+        try:
+            os.link(path, os.path.join(dst, name))
+        except OSError:
+            shutil.copyfile(path, os.path.join(dst, name))
+
+
+def unshare_file(path):
+    """
+    Replaces a file hard-linked elsewhere (see link_files) by a copy of its
+    own, before modifying it. Folders (whose link count is always above 1) are
+    left as they are.
+    """
+    if os.path.isfile(path) and os.stat(path).st_nlink > 1:
+        tmp = "{}.tmp{}".format(path, os.getpid())
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, path)
+
+
+class Cache(object):
+    """
+    Content-addressed cache in a folder, one subfolder per key. Once the total
+    size exceeds size_limit (in GB), the least recently used entries are evicted.
+    """
+
+    def __init__(self, folder, size_limit=None):
+        # Absolute, entry paths stay valid from any working directory (e.g. in sampling plans)
+        self.folder = os.path.abspath(folder)
+        self.size_limit = size_limit
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def entry(self, key):
+        """Path of the entry of key, None if there is none. Marks the entry as used."""
+        path = os.path.join(self.folder, key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def add(self, key, write):
+        """
+        Creates the entry of key by calling write(path) on a temporary folder,
+        which is moved into place once complete. Returns the path of the entry.
+        """
+        path = os.path.join(self.folder, key)
+        tmp = "{}.tmp{}".format(path, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        try:
+            write(tmp)
+            if os.path.exists(path):
+                shutil.rmtree(tmp)
+            else:
+                os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return path
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache fits size_limit."""
+        if not self.size_limit:
+            return
+        entries = []
+        for key in os.listdir(self.folder):
+            path = os.path.join(self.folder, key)
+            if ".tmp" in key or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), key, folder_size(path)))
+        total = sum(entry[2] for entry in entries)
+        for mtime, key, size in sorted(entries):
+            if total <= self.size_limit * 1024**3:
+                break
+            if key == keep:
+                continue
+            print("Evicting {} from cache {}.".format(key, self.folder))
+            shutil.rmtree(os.path.join(self.folder, key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,150 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse
+
+
+MANIFEST = "manifest.json"
+
+
+class ColumnSubset(object):
+    """
+    Columns columns (indices) of the array or sparse matrix X, without
+    copying X. Rows are read as X[rows][:, columns], e.g. per training batch
+    of a memory-mapped X.
+    """
+
+    def __init__(self, X, columns):
+        self.X = X
+        self.columns = columns
+        self.shape = (X.shape[0], len(columns))
+        self.dtype = X.dtype
+
+    def __getitem__(self, rows):
+        return self.X[rows][:, self.columns]
+
+
+def save_dataset(path, arrays, index):
+    """
+    Writes a prepared dataset to the folder path: every array of arrays
+    ({name: array}) as a contiguous .npy file, in its own dtype, the names in
+    index ({name: list of str}, e.g. genes) as index.npz, and manifest.json
+    listing them with their shapes and dtypes. Sparse arrays are written as
+    CSR, their data, indices and indptr in one .npy file each.
+    """
+    manifest = {"arrays": {}, "index": "index.npz"}
+    for name, X in arrays.items():
+        if issparse(X):
+            X = csr_matrix(X)
+            manifest["arrays"][name] = {
+                "format": "csr",
+                "files": {},
+                "shape": list(X.shape),
+                "dtype": str(X.dtype),
+            }
+            for part in ["data", "indices", "indptr"]:
+                file = "{}_{}.npy".format(name, part)
+                np.save(os.path.join(path, file), getattr(X, part), allow_pickle=False)
+                manifest["arrays"][name]["files"][part] = file
+            continue
+        X = np.ascontiguousarray(X)
+        np.save(os.path.join(path, name + ".npy"), X, allow_pickle=False)
+        manifest["arrays"][name] = {
+            "file": name + ".npy",
+            "shape": list(X.shape),
+            "dtype": str(X.dtype),
+        }
+    np.savez(
+        os.path.join(path, manifest["index"]),
+        **{name: np.array(names, dtype=str) for name, names in index.items()}
+    )
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def save_dataset_view(path, views, index, sources=None):
+    """
+    Writes a prepared dataset to the folder path whose arrays are parts of the
+    arrays of other prepared datasets, which are not copied. views maps every
+    name to (folder, name in folder, columns, rows): the columns (indices,
+    None for all) and the number of leading rows (None for all) of the array.
+    sources (e.g. the keys of the datasets) are kept in manifest.json.
+    """
+    manifest = {"arrays": {}, "index": "index.npz", "sources": sources}
+    for name, (folder, source, columns, rows) in views.items():
+        with open(os.path.join(folder, MANIFEST)) as f:
+            info = json.load(f)["arrays"][source]
+        if "files" in info:
+            info["files"] = {
+                part: os.path.relpath(os.path.join(folder, file), path)
+                for part, file in info["files"].items()
+            }
+        else:
+            info["file"] = os.path.relpath(os.path.join(folder, info["file"]), path)
+        # shape stays the one of the stored array, rows and columns select from it
+        if rows is not None:
+            info["rows"] = int(rows)
+        if columns is not None:
+            info["columns"] = name + "_columns.npy"
+            np.save(os.path.join(path, info["columns"]), np.asarray(columns, dtype=np.int64))
+        manifest["arrays"][name] = info
+    np.savez(
+        os.path.join(path, manifest["index"]),
+        **{name: np.array(names, dtype=str) for name, names in index.items()}
+    )
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def dataset_sources(path):
+    """sources of the prepared dataset in the folder path, see save_dataset_view. None if there are none."""
+    if not os.path.exists(os.path.join(path, MANIFEST)):
+        return None
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f).get("sources")
+
+
+def load_dataset(path, mmap=True):
+    """
+    Arrays ({name: array}, memory-mapped if mmap) and index ({name: list of
+    str}) of the prepared dataset in the folder path, see save_dataset.
+    Sparse arrays are returned as csr_matrix of their (memory-mapped) parts,
+    arrays of a view (see save_dataset_view) as ColumnSubset if only some of
+    their columns are used.
+    Datasets prepared before manifest.json existed are read from their .npy
+    and .txt files.
+    """
+    mmap_mode = "r" if mmap else None
+    if not os.path.exists(os.path.join(path, MANIFEST)):
+        arrays = {
+            name[: -len(".npy")]: np.load(os.path.join(path, name), allow_pickle=True)
+            for name in os.listdir(path)
+            if name.endswith(".npy")
+        }
+        index = {
+            name[: -len(".txt")]: pd.read_table(os.path.join(path, name), index_col=0).index.tolist()
+            for name in os.listdir(path)
+            if name.endswith(".txt")
+        }
+        return arrays, index
+
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    arrays = {}
+    for name, info in manifest["arrays"].items():
+        if info.get("format") == "csr":
+            parts = [
+                np.load(os.path.join(path, info["files"][part]), mmap_mode=mmap_mode)
+                for part in ["data", "indices", "indptr"]
+            ]
+            arrays[name] = csr_matrix(tuple(parts), shape=tuple(info["shape"]))
+        else:
+            arrays[name] = np.load(os.path.join(path, info["file"]), mmap_mode=mmap_mode)
+        if "rows" in info:
+            arrays[name] = arrays[name][: info["rows"]]
+        if "columns" in info:
+            arrays[name] = ColumnSubset(arrays[name], np.load(os.path.join(path, info["columns"])))
+    with np.load(os.path.join(path, manifest["index"])) as names:
+        index = {name: names[name].tolist() for name in names.files}
+    return arrays, index
@@ -0,0 +1,100 @@
+import os
+import re
+import hashlib
+import numpy as np
+import pandas as pd
+
+try:
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+
+CACHE_FOLDER = ".dissect_cache"
+
+
+def _parse_table(path):
+    """
+    Parses a tab-delimited table with row names in the first column, as
+    pd.read_table(path, index_col=0). Uses the multi-threaded pyarrow reader
+    if pyarrow is installed, pandas otherwise or if pyarrow can not parse it.
+    Tables with duplicated column names are read by pandas, which renames
+    them (.1, ...) as downstream code expects.
+    """
+    if pa_csv is not None:
+        try:
+            table = pa_csv.read_csv(
+                path,
+                read_options=pa_csv.ReadOptions(use_threads=True),
+                parse_options=pa_csv.ParseOptions(delimiter="\t"),
+            )
+            if len(set(table.column_names)) != len(table.column_names):
+                raise ValueError("duplicated column names")
+            index = pd.Index(table.column(0).to_numpy(zero_copy_only=False), name=table.column_names[0] or None)
+            return pd.DataFrame(
+                np.column_stack([table.column(i).to_numpy() for i in range(1, table.num_columns)]),
+                index=index,
+                columns=table.column_names[1:],
+            )
+        except Exception:
+            pass
+    return pd.read_table(path, index_col=0)
+
+
+def _cache_paths(path):
+    """
+    Prefix and files of the cache of path, keyed on its absolute path, size
+    and mtime: <prefix>-<key>.npy and <prefix>-<key>-names.npz.
+    """
+    stat = os.stat(path)
+    key = hashlib.sha1(
+        "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode()
+    ).hexdigest()[:16]
+    prefix = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_FOLDER, os.path.basename(path))
+    return prefix, "{}-{}.npy".format(prefix, key), "{}-{}-names.npz".format(prefix, key)
+
+
+def read_table_cached(path):
+    """
+    Reads the tab-delimited numeric table path (e.g. a txt test_dataset) as
+    pd.read_table(path, index_col=0) would. The first read parses the text
+    and stores the values (.npy) and row and column names (.npz) in a
+    .dissect_cache folder next to it, later reads load these while path keeps
+    its size and modification time.
+    """
+    prefix, values_path, names_path = _cache_paths(path)
+    if os.path.exists(values_path) and os.path.exists(names_path):
+        with np.load(names_path) as names:
+            # Row names keep the dtype the text was parsed to, e.g. int
+            index = pd.Index(names["index"], name=str(names["index_name"]) or None)
+            columns = names["columns"].tolist()
+        return pd.DataFrame(np.load(values_path), index=index, columns=columns)
+
+    df = _parse_table(path)
+    values = df.to_numpy()
+    if values.dtype == object:
+        return df
+    try:
+        os.makedirs(os.path.dirname(values_path), exist_ok=True)
+        # Caches of earlier versions of the file are replaced, not those of other files
+        folder = os.path.dirname(values_path)
+        pattern = re.compile(re.escape(os.path.basename(prefix)) + r"-[0-9a-f]{16}(\.npy|-names\.npz)(\.tmp\d+)?$")
+        for name in os.listdir(folder):
+            if pattern.match(name):
+                os.remove(os.path.join(folder, name))
+        tmp = "{}.tmp{}".format(values_path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp, values_path)
+        tmp = "{}.tmp{}".format(names_path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                index=df.index.to_numpy() if df.index.dtype.kind in "biuf" else np.array(df.index.astype(str), dtype=str),
+                index_name=np.array(df.index.name or ""),
+                columns=np.array(df.columns.astype(str), dtype=str),
+            )
+        os.replace(tmp, names_path)
+    except OSError:
+        print("Could not cache {} next to it, it will be parsed again.".format(path))
+    return df
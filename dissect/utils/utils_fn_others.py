@@ -5,6 +5,7 @@ import pandas as pd
 import scanpy as sc
 
 import scipy
+from dissect.utils.ingest import read_table_cached
 
 
 def convert_h5ad_to_df(adata):
@@ -69,7 +70,7 @@ def save_sc(ref, savedir, method):
 
 def save_test(test_path, test_format, savedir, method, remove_duplicates=True):
     if test_format == "txt":
-        df = pd.read_table(test_path, index_col=0)
+        df = read_table_cached(test_path)
     if remove_duplicates:
         df = df.loc[~df.index.duplicated(keep="first")]
     if method == "CS_datasets":